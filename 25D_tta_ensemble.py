@@ -13,16 +13,17 @@ import cv2
 import time
 import glob
 import random
+import csv
+from collections import OrderedDict
 
 from cv2 import transform
-import cupy as cp # https://cupy.dev/ => pip install cupy-cuda102
 import numpy as np
 import pandas as pd
 from glob import glob
 from tqdm import tqdm
 
 import torch 
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, IterableDataset, DataLoader, get_worker_info
 from torch.cuda import amp # https://pytorch.org/docs/stable/notes/amp_examples.html
 
 from sklearn.model_selection import StratifiedGroupKFold 
@@ -67,35 +68,131 @@ def path2info(row):
     # row['id'] = f'case{case}_day{day}_slice_{slice_}'
     return row
 
+def ids2info(df):
+    # vectorized get_metadata over the whole id column, eg: 'case123_day20_slice_0001'
+    info = df['id'].str.extract(r'^case(\d+)_day(\d+)_slice_(\d+)$')
+    info.columns = ['case', 'day', 'slice']
+    return df.assign(**{col: pd.to_numeric(info[col]).astype('Int64') for col in info.columns})
+
+def paths2info(df):
+    # vectorized path2info over the whole image_path column,
+    # eg: '.../case123/case123_day20/scans/slice_0001_266_266_1.50_1.50.png'
+    info = df['image_path'].str.extract(r'case(\d+)_day(\d+)[/\\]scans[/\\]slice_(\d+)_(\d+)_(\d+)_[^/\\]*$')
+    info.columns = ['case', 'day', 'slice', 'width', 'height']
+    return df.assign(**{col: pd.to_numeric(info[col]).astype('Int64') for col in ['height', 'width', 'case', 'day', 'slice']})
+
+def rle_encode_batch(msks):
+    '''
+    msks: numpy array [n, h, w, c], 1 - mask, 0 - background
+    Returns n*c run length strings (image by image, class by class), same format as mask2rle
+    '''
+    n, h, w, c = msks.shape
+    pixels = np.ascontiguousarray(msks.transpose(0, 3, 1, 2)).reshape(n*c, h*w) != 0 # one row per mask
+    pixels = np.pad(pixels, ((0, 0), (1, 1))) # pad 0 at both ends of every row
+    edges = np.flatnonzero(pixels[:, 1:] != pixels[:, :-1]) # index into the flattened [n*c, h*w+1] edge map
+    counts = np.diff(np.searchsorted(edges, np.arange(n*c+1) * (h*w+1))) # edges per row
+    runs = (edges - np.repeat(np.arange(n*c) * (h*w+1), counts) + 1).astype(np.int32)
+    runs[1::2] -= runs[::2] # every row has an even number of edges, so start/length pairs never straddle two rows
+
+    ##### format all numbers at once: right-aligned ascii digits + ' ', then drop the leading padding
+    n_digits = len(str(h*w+1))
+    chars = np.full((len(runs), n_digits+1), ord(' '), dtype=np.uint8)
+    widths = np.zeros(len(runs), dtype=np.int32)
+    rest = runs.copy()
+    for col in range(n_digits-1, -1, -1):
+        chars[:, col] = rest % 10 + ord('0')
+        widths += (rest > 0) | (col == n_digits-1)
+        rest //= 10
+    text = chars[np.arange(n_digits+1) >= (n_digits - widths)[:, None]].tobytes()
+    ends = np.cumsum(np.bincount(np.repeat(np.arange(n*c), counts), weights=widths+1, minlength=n*c)).astype(np.int64).tolist()
+    starts = [0] + ends[:-1]
+    return [text[start:end-1].decode() if end > start else '' for start, end in zip(starts, ends)]
+
 def mask2rle(msk, thr=0.5):
     '''
     img: numpy array, 1 - mask, 0 - background
     Returns run length as string formated
     '''
-    msk    = cp.array(msk)
-    pixels = msk.flatten()
-    pad    = cp.array([0])
-    pixels = cp.concatenate([pad, pixels, pad])
-    runs   = cp.where(pixels[1:] != pixels[:-1])[0] + 1
-    runs[1::2] -= runs[::2]
-    return ' '.join(str(x) for x in runs)
+    return rle_encode_batch(msk[None, :, :, None])[0]
+
+def rle_decode_batch(rles, height, width):
+    '''
+    rles: n lists of c run length strings ('' or NaN - empty), same format as mask2rle
+    Returns float32 numpy array [n, h, w, c], 1 - mask, 0 - background
+    '''
+    n, c = len(rles), len(rles[0]) if len(rles) else 0
+    tokens = [rle.split() if isinstance(rle, str) else [] for image_rles in rles for rle in image_rles]
+    runs = np.array([token for rle_tokens in tokens for token in rle_tokens], dtype=np.int64).reshape(-1, 2) # [start, length]
+    masks = np.repeat(np.arange(n*c), [len(rle_tokens)//2 for rle_tokens in tokens]) # image*c + class of every run
+
+    ##### every pixel of every run at once: run start repeated run length times + its offset inside the run
+    starts, lengths = runs[:, 0]-1, runs[:, 1]
+    pixels = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+    masks = np.repeat(masks, lengths)
+    decoded = np.zeros((n, height, width, c), dtype='float32')
+    decoded.reshape(-1)[(masks//c*height*width + pixels)*c + masks%c] = 1
+    return decoded
 
 def masks2rles(msks, ids, heights, widths):
     pred_strings = []; pred_ids = []; pred_classes = [];
+    ##### back to original shape, then encode all images of the same shape in one pass
+    shape_groups = {}
     for idx in range(msks.shape[0]):
         height = heights[idx].item()
         width = widths[idx].item()
         msk = cv2.resize(msks[idx], 
                         dsize=(width, height), 
                         interpolation=cv2.INTER_NEAREST) # back to original shape
-        rle = [None]*3
-        for midx in [0, 1, 2]:
-            rle[midx] = mask2rle(msk[...,midx])
-        pred_strings.extend(rle)
-        pred_ids.extend([ids[idx]]*len(rle))
+        shape_groups.setdefault((height, width), []).append((idx, msk))
+
+    rles = [None]*msks.shape[0]
+    for group in shape_groups.values():
+        group_rles = rle_encode_batch(np.stack([msk for _, msk in group])) # [n, h, w, 3] => n*3 rles
+        for i, (idx, _) in enumerate(group):
+            rles[idx] = group_rles[3*i:3*i+3]
+
+    for idx in range(msks.shape[0]):
+        pred_strings.extend(rles[idx])
+        pred_ids.extend([ids[idx]]*len(rles[idx]))
         pred_classes.extend(['large_bowel', 'small_bowel', 'stomach'])
     return pred_strings, pred_ids, pred_classes
 
+class SubmissionWriter:
+    """
+    stream predictions into the submission csv in the order of the submission template.
+    a row is written once every row before it in the template is known, and the file is
+    flushed after every batch, so a crash leaves a shorter but still valid csv.
+    """
+    def __init__(self, save_path, template_df):
+        self.template = list(zip(template_df['id'], template_df['class'])) # submission order
+        self.cursor = 0
+        self.pending = {} # {(id, class): rle}, predictions that arrived ahead of the template order
+        self.file = open(save_path, 'w', newline='')
+        self.writer = csv.writer(self.file, lineterminator='\n') # same line ending as DataFrame.to_csv
+        self.writer.writerow(['id', 'class', 'predicted'])
+        self.file.flush()
+
+    def write(self, pred_strings, pred_ids, pred_classes):
+        self.pending.update(zip(zip(pred_ids, pred_classes), pred_strings))
+        rows = []
+        while self.cursor < len(self.template) and self.template[self.cursor] in self.pending:
+            id_, class_ = self.template[self.cursor]
+            rows.append([id_, class_, self.pending.pop((id_, class_))])
+            self.cursor += 1
+        self.writer.writerows(rows)
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+        if self.cursor < len(self.template):
+            print("submission: {} of {} rows written".format(self.cursor, len(self.template)), flush=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
 ###############################################################
 #part1: build_transforms & build_dataset & build_dataloader
 ###############################################################
@@ -123,8 +220,152 @@ def build_transforms(CFG):
         }
     return data_transforms
 
+class SliceCache:
+    """
+    per-(case, day) cache of decoded scan slices with LRU eviction.
+    neighbouring 2.5d stacks share most of their slices, so every png is decoded once
+    as long as its volume stays inside the byte budget. that holds for the in-order (shuffle=False)
+    valid/test loaders only: a shuffled train loader jumps between volumes and its workers restart
+    empty every epoch, so build_dataloader turns the cache off for train.
+    max_bytes is the total budget: each DataLoader worker holds its own cache, so on first use
+    a worker takes max_bytes // num_workers. the counters sit in shared memory, one row per process
+    (0: main, i+1: worker i), so stats() covers the workers too.
+    """
+    def __init__(self, max_bytes, max_workers=64):
+        self.total_bytes = max_bytes
+        self.max_bytes = None # this process' share, see attach
+        self.counters = torch.zeros((max_workers+1, 4), dtype=torch.int64).share_memory_() # [process, (hits, misses, volumes, bytes)]
+        self.pid = None # process the cache belongs to, see attach
+        self.volumes = OrderedDict() # {'.../case123_day20/scans': {slice_path: img or None}}
+        self.nbytes = 0
+
+    def __getstate__(self):
+        # DataLoader workers start with an empty cache, the shared counters go along
+        state = self.__dict__.copy()
+        state.update(pid=None, volumes=OrderedDict(), nbytes=0, count=None)
+        return state
+
+    def attach(self):
+        # first use in this process: its share of the budget, its counter row, an empty cache
+        worker_info = get_worker_info() # None in the main process
+        num_workers, row = (1, 0) if worker_info is None else (worker_info.num_workers, worker_info.id + 1)
+        assert row < len(self.counters), f"more than {len(self.counters)-1} DataLoader workers"
+        self.max_bytes = self.total_bytes // num_workers
+        self.count = self.counters[row].numpy() # shares the memory of self.counters
+        self.volumes = OrderedDict()
+        self.nbytes = 0
+        self.pid = os.getpid()
+
+    def get(self, img_path):
+        if self.pid != os.getpid(): # forked workers inherit the parent's cache
+            self.attach()
+        volume_key = os.path.dirname(img_path)
+        volume = self.volumes.get(volume_key)
+        if volume is None:
+            volume = self.volumes[volume_key] = {}
+        self.volumes.move_to_end(volume_key) # mark as most recently used
+
+        if img_path in volume:
+            self.count[0] += 1
+            return volume[img_path]
+
+        self.count[1] += 1
+        if os.path.exists(img_path):
+            img = cv2.imread(img_path, cv2.IMREAD_UNCHANGED) # [w, h]
+        else:
+            img = None # missing neighbours are cached as well, saves the os.path.exists
+        if self.max_bytes > 0:
+            volume[img_path] = img
+            self.nbytes += 0 if img is None else img.nbytes
+            self.evict()
+        else:
+            self.volumes.pop(volume_key)
+        self.count[2] = len(self.volumes)
+        self.count[3] = self.nbytes
+        return img
+
+    def evict(self):
+        # drop whole volumes, least recently used first, but never the one in use
+        while self.nbytes > self.max_bytes and len(self.volumes) > 1:
+            _, volume = self.volumes.popitem(last=False)
+            self.nbytes -= sum(img.nbytes for img in volume.values() if img is not None)
+
+    def reset(self):
+        self.counters.zero_()
+
+    def stats(self):
+        # summed over the main process & every worker since the last reset, volumes & mbytes as last seen
+        hits, misses, volumes, nbytes = self.counters.sum(dim=0).tolist()
+        return {"hits": hits, "misses": misses, "hit_rate": hits / max(hits + misses, 1),
+                "volumes": volumes, "mbytes": nbytes / 1024**2, "max_mbytes": self.total_bytes / 1024**2}
+
+class VolumeStore:
+    """
+    read side of pack_volumes.py: one uint16 memmap per case/day + index.csv.
+    a 2.5d stack of neighbouring slices is a zero-copy view of the memmap, and all
+    DataLoader workers share the same page cache instead of opening thousands of pngs.
+    """
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        index = pd.read_csv(f'{store_dir}/index.csv')
+        self.positions = dict(zip(zip(index.volume, index.slice), index.position)) # {(volume, slice): row}
+        self.volumes = {} # opened lazily, so every worker maps the files itself
+
+    def __getstate__(self):
+        # never pickle opened memmaps into DataLoader workers
+        state = self.__dict__.copy()
+        state['volumes'] = {}
+        return state
+
+    def get_volume(self, volume):
+        if volume not in self.volumes:
+            self.volumes[volume] = np.load(f'{self.store_dir}/{volume}.npy', mmap_mode='r') # [n, w, h]
+        return self.volumes[volume]
+
+    def load_stack(self, middle_img_path, n_25d_shift):
+        volume = os.path.basename(os.path.dirname(os.path.dirname(middle_img_path))) # eg: case123_day20
+        middle_slice_num = int(os.path.basename(middle_img_path).split('_')[1])
+
+        ##### same rule as the png path: a missing slice is filled by its inner neighbour
+        positions = [None]*(2*n_25d_shift+1)
+        positions[n_25d_shift] = self.positions.get((volume, middle_slice_num))
+        if positions[n_25d_shift] is None:
+            return None # not packed (eg: the test scans), the caller reads the pngs
+        for related_idx in range(1, n_25d_shift+1):
+            left = self.positions.get((volume, middle_slice_num-related_idx))
+            right = self.positions.get((volume, middle_slice_num+related_idx))
+            positions[n_25d_shift-related_idx] = left if left is not None else positions[n_25d_shift-related_idx+1]
+            positions[n_25d_shift+related_idx] = right if right is not None else positions[n_25d_shift+related_idx-1]
+
+        packed = self.get_volume(volume)
+        if positions == list(range(positions[0], positions[-1]+1)):
+            stack = packed[positions[0]:positions[-1]+1] # zero-copy view
+        else:
+            stack = packed[positions] # volume border, copies
+        return stack.transpose(1, 2, 0) # [c, w, h] => [w, h, c]
+
+class MaskStore(VolumeStore):
+    """
+    read side of pack_masks.py: the 0/255 [h, w, 3] masks bit-packed to 1 bit per pixel & class,
+    one memmap per case/day + index.csv. a slice is unpacked straight into the float32 [0, 1]
+    mask the augmentations take, with 1/8 of the bytes of the npy tree to read.
+    """
+    def __init__(self, store_dir):
+        super().__init__(store_dir)
+        index = pd.read_csv(f'{store_dir}/index.csv')
+        self.shapes = dict(zip(index.volume, zip(index.height, index.width))) # {volume: (h, w)}
+
+    def load(self, mask_path):
+        #### eg: mask_path: '.../case123/case123_day20/scans/slice_0001.npy'
+        volume = os.path.basename(os.path.dirname(os.path.dirname(mask_path))) # eg: case123_day20
+        slice_num = int(os.path.basename(mask_path)[:-4].split('_')[1])
+        height, width = self.shapes[volume]
+        bits = self.get_volume(volume)[self.positions[(volume, slice_num)]] # [h, ceil(w*3/8)]
+        mask = np.unpackbits(bits, axis=-1, count=width*3).reshape(height, width, 3)
+        return mask.astype('float32')
+
 class build_dataset(Dataset):
-    def __init__(self, df, label=True, transforms=None, cfg=None):
+    def __init__(self, df, label=True, transforms=None, cfg=None, slice_cache=True):
         self.df = df
         self.label = label
         self.img_paths = df['image_path'].tolist() # image
@@ -137,6 +378,10 @@ class build_dataset(Dataset):
 
         self.transforms = transforms
         self.n_25d_shift = cfg.n_25d_shift
+        self.slice_cache = SliceCache(cfg.slice_cache_mb * 1024**2 if slice_cache else 0) # off => counts the misses only
+        self.volume_store = VolumeStore(cfg.volume_store) if cfg.volume_store else None
+        self.mask_store = MaskStore(cfg.mask_store) if cfg.mask_store else None
+        self.rles = df['segmentation'].tolist() if cfg.mask_from_rle else None # decoded on the fly
 
     def __len__(self):
         return len(self.df)
@@ -151,9 +396,14 @@ class build_dataset(Dataset):
         
         if self.label: # train
             #### load mask
-            mask_path = self.mask_paths[index]
-            mask = np.load(mask_path).astype('float32')
-            mask/=255.0 # scale mask to [0, 1]
+            if self.rles is not None:
+                mask = rle_decode_batch([self.rles[index]], h, w)[0] # already in [0, 1]
+            elif self.mask_store is not None:
+                mask = self.mask_store.load(self.mask_paths[index]) # already in [0, 1]
+            else:
+                mask_path = self.mask_paths[index]
+                mask = np.load(mask_path).astype('float32')
+                mask/=255.0 # scale mask to [0, 1]
 
             ### augmentations
             data = self.transforms(image=img, mask=mask)
@@ -174,11 +424,18 @@ class build_dataset(Dataset):
     #construct 2.5d slice images <<<<<<
     ###############################################################
     def load_2_5d_slice(self, middle_img_path):
+        new_25d_imgs = None if self.volume_store is None else self.volume_store.load_stack(middle_img_path, self.n_25d_shift)
+        if new_25d_imgs is not None:
+            new_25d_imgs = new_25d_imgs.astype('float32') # [w, h, c]
+            mx_pixel = new_25d_imgs.max()
+            if mx_pixel != 0:
+                new_25d_imgs /= mx_pixel
+            return new_25d_imgs
+
         #### step1: capture info from the middle image
         #### eg: middle_img_path: 'slice_0005_266_266_1.50_1.50.png' 
         middle_slice_num = os.path.basename(middle_img_path).split('_')[1] # eg: 0005
         middle_str = 'slice_'+middle_slice_num
-        middle_img = cv2.imread(middle_img_path, cv2.IMREAD_UNCHANGED)
 
         new_25d_imgs = []
 
@@ -189,11 +446,8 @@ class build_dataset(Dataset):
             shift_str = 'slice_'+str(shift_slice_num).zfill(4)
             shift_img_path = middle_img_path.replace(middle_str, shift_str)
             
-            if os.path.exists(shift_img_path):
-                shift_img = cv2.imread(shift_img_path, cv2.IMREAD_UNCHANGED) # [w, h]
-                new_25d_imgs.append(shift_img)
-            else:
-                new_25d_imgs.append(None)
+            shift_img = self.slice_cache.get(shift_img_path) # [w, h], None if no such slice
+            new_25d_imgs.append(shift_img)
         
         ##### step3: Loop from the center to the outside, fill in the value of None in turn
         ##### eg: n_25d_shift = 2, form 5 channels, idx is [0, 1, 2, 3, 4], so the idx processed in turn is [1, 3, 0, 4]
@@ -215,10 +469,65 @@ class build_dataset(Dataset):
             new_25d_imgs /= mx_pixel
         return new_25d_imgs
 
+class build_volume_dataset(IterableDataset):
+    """
+    test-time dataset in volume order (CFG.volume_infer): each case/day scans dir is decoded once,
+    sorted by slice, and every 2.5d stack is a window over the in-memory volume. the stack max used
+    for normalization comes from per-slice maxima computed once per volume.
+    yields the same (img, id, h, w) as build_dataset(label=False), grouped by volume instead of in df order;
+    DataLoader workers split the volumes between them.
+    """
+    def __init__(self, df, transforms=None, cfg=None):
+        self.df = df
+        self.transforms = transforms
+        self.n_25d_shift = cfg.n_25d_shift
+        scan_dirs = df['image_path'].map(os.path.dirname)
+        self.volumes = [(scan_dir, volume_df['id'].tolist(), volume_df['image_path'].tolist())
+                        for scan_dir, volume_df in df.groupby(scan_dirs, sort=False)]
+
+    def __len__(self):
+        return len(self.df)
+
+    def load_volume(self, scan_dir):
+        ##### every slice of the scan, not only the df rows: neighbours come from disk as in build_dataset
+        slice_paths = sorted(glob(f'{scan_dir}/slice_*.png')) # slice numbers are zero padded
+        volume = np.stack([cv2.imread(slice_path, cv2.IMREAD_UNCHANGED) for slice_path in slice_paths]) # [n, w, h]
+        positions = {int(os.path.basename(slice_path).split('_')[1]): position for position, slice_path in enumerate(slice_paths)}
+        slice_max = volume.reshape(len(volume), -1).max(axis=1).astype('float32') # [n]
+        return volume, positions, slice_max
+
+    def __iter__(self):
+        worker_info = torch.utils.data.get_worker_info()
+        volumes = self.volumes if worker_info is None else self.volumes[worker_info.id::worker_info.num_workers]
+        for scan_dir, ids, img_paths in volumes:
+            volume, positions, slice_max = self.load_volume(scan_dir)
+            for id, img_path in zip(ids, img_paths):
+                middle_slice_num = int(os.path.basename(img_path).split('_')[1])
+                ##### same rule as load_2_5d_slice: a missing slice is filled by its inner neighbour
+                stack_positions = [None]*(2*self.n_25d_shift+1)
+                stack_positions[self.n_25d_shift] = positions[middle_slice_num]
+                for related_idx in range(1, self.n_25d_shift+1):
+                    left = positions.get(middle_slice_num-related_idx)
+                    right = positions.get(middle_slice_num+related_idx)
+                    stack_positions[self.n_25d_shift-related_idx] = left if left is not None else stack_positions[self.n_25d_shift-related_idx+1]
+                    stack_positions[self.n_25d_shift+related_idx] = right if right is not None else stack_positions[self.n_25d_shift+related_idx-1]
+
+                img = volume[stack_positions].transpose(1, 2, 0).astype('float32') # [w, h, c]
+                mx_pixel = slice_max[stack_positions].max()
+                if mx_pixel != 0:
+                    img /= mx_pixel
+                h, w = img.shape[:2]
+
+                ### augmentations
+                data = self.transforms(image=img)
+                img  = data['image']
+                img = np.transpose(img, (2, 0, 1)) # [h, w, c] => [c, h, w]
+                yield torch.tensor(img), id, h, w
+
 def build_dataloader(df, fold, data_transforms, CFG):
     train_df = df.query("fold!=@fold").reset_index(drop=True)
     valid_df = df.query("fold==@fold").reset_index(drop=True)
-    train_dataset = build_dataset(train_df, label=True, transforms=data_transforms['train'], cfg=CFG)
+    train_dataset = build_dataset(train_df, label=True, transforms=data_transforms['train'], cfg=CFG, slice_cache=False) # shuffled, see SliceCache
     valid_dataset = build_dataset(valid_df, label=True, transforms=data_transforms['valid_test'], cfg=CFG)
 
     train_loader = DataLoader(train_dataset, batch_size=CFG.train_bs, num_workers=CFG.num_worker, shuffle=True, pin_memory=True, drop_last=False)
@@ -244,6 +553,16 @@ def build_model(CFG, test_flag=False):
     model.to(CFG.device)
     return model
 
+def build_model_pool(ckpt_paths, CFG):
+    # build & load every checkpoint once per inference run, then reuse it for all batches
+    models = []
+    for sub_ckpt_path in ckpt_paths:
+        model = build_model(CFG, test_flag=True)
+        model.load_state_dict(torch.load(sub_ckpt_path, map_location=CFG.device))
+        model.eval()
+        models.append(model)
+    return models
+
 ###############################################################
 #part3: build_loss
 ###############################################################
@@ -328,55 +647,97 @@ def valid_one_epoch(model, valid_loader, CFG):
     
     return val_dice, val_jaccard
 
+def predict_views(models, images, views, max_batch=None):
+    """
+    sum of the sigmoid outputs of every model on every flip view of the batch, flipped back.
+    the views are concatenated (view-major) and run in chunks of at most max_batch inputs per
+    forward; None => all views in one forward.
+    views: list of flip dims, [] => the batch as is.
+    returns (summed masks [b, c, w, h], n_preds, number of views covered by each forward)
+    """
+    b = images.shape[0]
+    n_inputs = len(views) * b
+    step = max_batch if max_batch else n_inputs
+    masks = None
+    n_preds = 0
+    views_per_forward = []
+    for model in models:
+        for start in range(0, n_inputs, step):
+            stop = min(start + step, n_inputs)
+            ##### (view, first image, last image) pieces of this chunk
+            pieces = [(i, max(start, i*b) - i*b, min(stop, (i+1)*b) - i*b) for i in range(start // b, (stop-1) // b + 1)]
+            chunk = torch.cat([torch.flip(images[lo:hi], views[i]) for i, lo, hi in pieces])
+            views_per_forward.append(len(pieces))
+            y_preds = torch.nn.Sigmoid()(model(chunk)) # [chunk, c, w, h]
+            if masks is None:
+                masks = images.new_zeros((b, *y_preds.shape[1:]))
+            offset = 0
+            for i, lo, hi in pieces:
+                masks[lo:hi] += torch.flip(y_preds[offset:offset+hi-lo], views[i])
+                offset += hi - lo
+        n_preds += len(views)
+    return masks, n_preds, views_per_forward
+
 @torch.no_grad()
-def test_one_epoch(ckpt_paths_dict, test_loader, CFG):
+def test_one_epoch(ckpt_paths_dict, test_loader, CFG, sub_writer=None):
     pred_strings = []
     pred_ids = []
     pred_classes = []
     
+    start_time = time.time()
+    models = []
+    for backbone_name, ckpt_paths in ckpt_paths_dict.items():
+        CFG.backbone = backbone_name
+        models.extend(build_model_pool(ckpt_paths, CFG))
+    load_time = time.time() - start_time
+    forward_time = 0
+    tta_skipped = 0
+    views_per_forward = []
+
     pbar = tqdm(enumerate(test_loader), total=len(test_loader), desc='Test: ')
     for _, (images, ids, h, w) in pbar:
 
         images  = images.to(CFG.device, dtype=torch.float) # [b, c, w, h]
-        size = images.size()
-        masks = torch.zeros((size[0], 3, size[2], size[3]), device=CFG.device, dtype=torch.float32) # [b, c, w, h]
         
         ############################################
         #cross validation & ensemble infer
         ############################################
-        total_ckpt_paths = len(ckpt_paths_dict) * CFG.n_fold
-
-        for backbone_name, ckpt_paths in ckpt_paths_dict.items():
-            CFG.backbone = backbone_name
-            for sub_ckpt_path in ckpt_paths:
-                model = build_model(CFG, test_flag=True)
-                model.load_state_dict(torch.load(sub_ckpt_path))
-                model.eval()
-                y_preds = model(images) # [b, c, w, h]
-                y_preds   = torch.nn.Sigmoid()(y_preds)
-                masks += y_preds
-
-                #x,y,xy flips as TTA
-                if CFG.tta:
-                    flips = [[-1],[-2],[-2,-1]]
-                    for f in flips:
-                        images_f = torch.flip(images, f)
-                        y_preds = model(images_f) # [b, c, w, h]
-                        y_preds = torch.flip(y_preds, f)
-                        y_preds   = torch.nn.Sigmoid()(y_preds)
-                        masks += y_preds
-
-        if CFG.tta:
-            total_ckpt_paths = len(ckpt_paths_dict) * CFG.n_fold * 4
+        start_time = time.time()
+        if CFG.tta and CFG.tta_early_stop:
+            ##### plain views first, flips only when enough pixels sit close to the threshold
+            masks, n_preds, forwards = predict_views(models, images, [[]], CFG.tta_max_batch)
+            views_per_forward.extend(forwards)
+            uncertain = ((masks/n_preds - CFG.thr).abs() < CFG.tta_margin).float().mean().item()
+            if uncertain > CFG.tta_uncertain_frac:
+                flip_masks, flip_preds, forwards = predict_views(models, images, CFG.tta_flips, CFG.tta_max_batch)
+                masks += flip_masks
+                n_preds += flip_preds
+                views_per_forward.extend(forwards)
+            else:
+                tta_skipped += 1
         else:
-            total_ckpt_paths = len(ckpt_paths_dict) * CFG.n_fold
-        masks /= total_ckpt_paths
+            #x,y,xy flips as TTA, the views share forwards of up to CFG.tta_max_batch inputs
+            views = [[]] + CFG.tta_flips if CFG.tta else [[]]
+            masks, n_preds, forwards = predict_views(models, images, views, CFG.tta_max_batch)
+            views_per_forward.extend(forwards)
+        masks /= n_preds
         
         masks = (masks.permute((0, 2, 3, 1))>CFG.thr).to(torch.uint8).cpu().detach().numpy() # [n, h, w, c]
+        forward_time += time.time() - start_time # .cpu() above waits for the gpu
         result = masks2rles(masks, ids, h, w)
-        pred_strings.extend(result[0])
-        pred_ids.extend(result[1])
-        pred_classes.extend(result[2])
+        if sub_writer is not None:
+            sub_writer.write(*result)
+        else:
+            pred_strings.extend(result[0])
+            pred_ids.extend(result[1])
+            pred_classes.extend(result[2])
+
+    print("load models: {:.2f}s, forward: {:.2f}s".format(load_time, forward_time), flush=True)
+    if CFG.tta:
+        ##### < 1 + len(CFG.tta_flips) => the views are split over forwards, lower the loader batch
+        print("tta: {} forwards, {:.2f} views per forward".format(len(views_per_forward), np.mean(views_per_forward)), flush=True)
+    if CFG.tta and CFG.tta_early_stop:
+        print("tta skipped on {} of {} batches".format(tta_skipped, len(test_loader)), flush=True)
     return pred_strings, pred_ids, pred_classes
 
 
@@ -393,6 +754,11 @@ if __name__ == '__main__':
 
         # step2: data
         n_25d_shift = 1
+        slice_cache_mb = 2048 # decoded-slice cache of the valid/test loaders, total over the DataLoader workers, 0 => off
+        volume_store = None # dir written by pack_volumes.py, None => read pngs (slices not packed there, eg: test, still come from png)
+        mask_store = None # dir written by pack_masks.py, None => read the npy mask tree
+        mask_from_rle = False # decode masks from the train.csv rles instead, no mask files needed
+        volume_infer = False # test set read volume by volume, see build_volume_dataset
         n_fold = 4
         img_size = [224, 224]
         train_bs = 128
@@ -416,6 +782,12 @@ if __name__ == '__main__':
         # step5: infer
         thr = 0.45
         tta = True
+        tta_flips = [[-1],[-2],[-2,-1]] # x, y, xy; [[-1]] => horizontal only (vertical flips may hurt, see README)
+        tta_early_stop = False # skip the flips on batches the plain forward is already sure about
+        tta_margin = 0.1 # |p - thr| below this counts as an uncertain pixel
+        tta_uncertain_frac = 0.001 # flips run only when more pixels than this fraction are uncertain
+        tta_max_batch = valid_bs # inputs per forward over all views, None => one forward
+        tta_bs = max(1, valid_bs // (1 + len(tta_flips))) if tta else valid_bs # images per test batch, every view of a batch fits in one forward
     
     test_flag = True
     if test_flag:
@@ -433,14 +805,17 @@ if __name__ == '__main__':
             sub_firset = False
             sub_df = sub_df.drop(columns=['class','predicted']).drop_duplicates()
             paths = glob(f'../input/uw-madison-gi-tract-image-segmentation/test/**/*png',recursive=True)
-        sub_df = sub_df.apply(get_metadata,axis=1)
+        sub_df = ids2info(sub_df)
         path_df = pd.DataFrame(paths, columns=['image_path'])
-        path_df = path_df.apply(path2info, axis=1)
+        path_df = paths2info(path_df)
         test_df = sub_df.merge(path_df, on=['case','day','slice'], how='left')
 
         data_transforms = build_transforms(CFG)
-        test_dataset = build_dataset(test_df, label=False, transforms=data_transforms['valid_test'], cfg=CFG)
-        test_loader  = DataLoader(test_dataset, batch_size=CFG.valid_bs, num_workers=2, shuffle=False, pin_memory=False)
+        if CFG.volume_infer: # each scan decoded once, stacks slide over the volume
+            test_dataset = build_volume_dataset(test_df, transforms=data_transforms['valid_test'], cfg=CFG)
+        else:
+            test_dataset = build_dataset(test_df, label=False, transforms=data_transforms['valid_test'], cfg=CFG)
+        test_loader  = DataLoader(test_dataset, batch_size=CFG.tta_bs, num_workers=2, shuffle=False, pin_memory=False)
 
         ###############################################################
         #step2: infer
@@ -452,22 +827,16 @@ if __name__ == '__main__':
         assert len(ckpt_paths_1) == CFG.n_fold and len(ckpt_paths_2) == CFG.n_fold, "ckpt path error!"
 
         ckpt_paths_dict = {CFG.backbone_1:ckpt_paths_1, CFG.backbone_2:ckpt_paths_2}
-        pred_strings, pred_ids, pred_classes = test_one_epoch(ckpt_paths_dict, test_loader, CFG)
 
         ###############################################################
-        #step3: submit
+        #step3: submit, rows are streamed into submission.csv batch by batch
         ###############################################################
-        pred_df = pd.DataFrame({
-            "id":pred_ids,
-            "class":pred_classes,
-            "predicted":pred_strings
-        })
         if not sub_firset:
             sub_df = pd.read_csv('../input/uw-madison-gi-tract-image-segmentation/sample_submission.csv')
             del sub_df['predicted']
         else:
             sub_df = pd.read_csv('../input/uw-madison-gi-tract-image-segmentation/train.csv')[:1000*3]
             del sub_df['segmentation']
-            
-        sub_df = sub_df.merge(pred_df, on=['id','class'])
-        sub_df.to_csv('submission.csv',index=False)
+
+        with SubmissionWriter('submission.csv', sub_df) as sub_writer:
+            test_one_epoch(ckpt_paths_dict, test_loader, CFG, sub_writer)
@@ -0,0 +1,125 @@
+###############################################################
+        #  benchmark: data-loading throughput of build_dataset & DataLoader
+        #  sweeps slice_cache_mb x n_25d_shift x img_size x num_worker x transforms x label
+        #  and reports the slice cache hit/miss counters of the DataLoader pass, summed over its workers
+        #  on a synthetic scan tree with the competition layout, so it runs offline
+        #  run from the repo root: python benchmarks/benchmark_dataloader.py
+###############################################################
+
+import os
+import sys
+import time
+import itertools
+import importlib
+import cv2
+import numpy as np
+import pandas as pd
+from torch.utils.data import DataLoader
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+script = importlib.import_module('25D') # file name is not a valid identifier
+
+def make_scan_tree(root, n_case=4, n_day=2, n_slice=80, shapes=((266, 266), (310, 360)), seed=66):
+    ###############################################################
+    # {root}/train/case{c}/case{c}_day{d}/scans/slice_XXXX_W_H_1.50_1.50.png (uint16)
+    # {root}/np/case{c}/case{c}_day{d}/scans/slice_XXXX.npy ([h, w, 3] uint8, 0/255)
+    # returns a train-like df: id, case, day, slice, image_path, mask_path, empty
+    ###############################################################
+    rng = np.random.default_rng(seed)
+    rows = []
+    for case in range(1, n_case+1):
+        height, width = shapes[case % len(shapes)]
+        for day in range(n_day):
+            scan_dir = f'{root}/train/case{case}/case{case}_day{day}/scans'
+            mask_dir = f'{root}/np/case{case}/case{case}_day{day}/scans'
+            os.makedirs(scan_dir, exist_ok=True)
+            os.makedirs(mask_dir, exist_ok=True)
+            for slice_ in range(1, n_slice+1):
+                image_path = f'{scan_dir}/slice_{slice_:04d}_{width}_{height}_1.50_1.50.png'
+                mask_path = f'{mask_dir}/slice_{slice_:04d}.npy'
+                if not os.path.exists(image_path):
+                    cv2.imwrite(image_path, rng.integers(0, 4096, (height, width), dtype=np.uint16))
+                    mask = np.zeros((height, width, 3), dtype=np.uint8)
+                    if rng.random() < 0.5:
+                        y, x = rng.integers(0, height//2), rng.integers(0, width//2)
+                        mask[y:y+height//3, x:x+width//3, rng.integers(0, 3)] = 255
+                    np.save(mask_path, mask)
+                rows.append({"id": f'case{case}_day{day}_slice_{slice_:04d}', "case": case, "day": day, "slice": slice_,
+                             "image_path": image_path, "mask_path": mask_path,
+                             "empty": not np.load(mask_path, mmap_mode='r').any()})
+    return pd.DataFrame(rows)
+
+def percentile_ms(latencies, q):
+    return np.percentile(latencies, q) * 1000
+
+def bench_getitem(dataset, n_samples):
+    # single process, per-sample latency of __getitem__
+    latencies = []
+    for index in range(min(n_samples, len(dataset))):
+        start_time = time.perf_counter()
+        dataset[index]
+        latencies.append(time.perf_counter() - start_time)
+    return {"getitem_sps": len(latencies) / sum(latencies),
+            "p50_ms": percentile_ms(latencies, 50), "p95_ms": percentile_ms(latencies, 95), "p99_ms": percentile_ms(latencies, 99)}
+
+def bench_loader(dataset, batch_size, num_worker, n_batches, shuffle):
+    # full DataLoader, first batch (worker start-up) is not timed
+    loader = DataLoader(dataset, batch_size=batch_size, num_workers=num_worker, shuffle=shuffle, pin_memory=False)
+    n_samples = 0
+    start_time = None
+    for batch_idx, batch in enumerate(loader):
+        if batch_idx == 0:
+            start_time = time.perf_counter()
+            continue
+        n_samples += len(batch[0])
+        if batch_idx == n_batches:
+            break
+    return {"loader_sps": n_samples / max(time.perf_counter() - start_time, 1e-9)}
+
+
+if __name__ == '__main__':
+    class CFG:
+        root = './bench_scan_tree'
+        n_case = 4
+        n_day = 2
+        n_slice = 80
+
+        n_25d_shifts = [1, 2]
+        img_sizes = [[224, 224], [384, 384]]
+        num_workers = [0, 4]
+        transforms = ['train', 'valid_test']
+        labels = [True, False]
+
+        batch_size = 32
+        n_getitem = 200 # samples timed one by one
+        n_batches = 10 # batches timed through the DataLoader
+        slice_cache_mbs = [0, 2048] # 0 => raw png decoding, as before the slice cache
+        volume_store = None
+        mask_store = None
+        mask_from_rle = False
+        save_path = './bench_dataloader.csv'
+
+    df = make_scan_tree(CFG.root, CFG.n_case, CFG.n_day, CFG.n_slice)
+    results = []
+    for slice_cache_mb, n_25d_shift, img_size, num_worker, transform, label in itertools.product(
+            CFG.slice_cache_mbs, CFG.n_25d_shifts, CFG.img_sizes, CFG.num_workers, CFG.transforms, CFG.labels):
+        CFG.slice_cache_mb = slice_cache_mb
+        CFG.n_25d_shift = n_25d_shift
+        CFG.img_size = img_size
+        data_transforms = script.build_transforms(CFG)
+        dataset = script.build_dataset(df, label=label, transforms=data_transforms[transform], cfg=CFG)
+
+        result = {"slice_cache_mb": slice_cache_mb, "n_25d_shift": n_25d_shift, "img_size": img_size[0], "num_worker": num_worker,
+                  "transforms": transform, "label": label}
+        if num_worker == CFG.num_workers[0]: # __getitem__ does not depend on num_worker
+            result.update(bench_getitem(dataset, CFG.n_getitem))
+        ##### shuffled like the train loader or in order like valid/test, on a cold cache
+        dataset = script.build_dataset(df, label=label, transforms=data_transforms[transform], cfg=CFG)
+        result.update(bench_loader(dataset, CFG.batch_size, num_worker, CFG.n_batches, shuffle=(transform == 'train')))
+        result.update({f"cache_{key}": value for key, value in dataset.slice_cache.stats().items()})
+        results.append(result)
+        print(result, flush=True)
+
+    results = pd.DataFrame(results)
+    results.to_csv(CFG.save_path, index=False)
+    print(results.to_string(index=False, float_format='{:.1f}'.format), flush=True)
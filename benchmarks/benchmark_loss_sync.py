@@ -0,0 +1,91 @@
+###############################################################
+        #  benchmark: per-step time of train_one_epoch with the loss read back
+        #  every step (.item() x3, as before) vs accumulated on device and
+        #  read back every CFG.log_interval steps
+        #  batches are pre-built on the device so only the training step is timed
+        #  run from the repo root: python benchmarks/benchmark_loss_sync.py
+###############################################################
+
+import os
+import sys
+import time
+import importlib
+import numpy as np
+import pandas as pd
+import torch
+from torch.cuda import amp
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+script = importlib.import_module('25D') # file name is not a valid identifier
+
+def item_train_one_epoch(model, train_loader, optimizer, losses_dict, CFG):
+    # the previous loop body: three .item() => three device syncs per step
+    model.train()
+    scaler = amp.GradScaler()
+    losses_all, bce_all, tverskly_all = 0, 0, 0
+    for images, masks in train_loader:
+        optimizer.zero_grad()
+        with amp.autocast(enabled=True):
+            y_preds = model(images)
+            bce_loss = losses_dict["BCELoss"](y_preds, masks)
+            tverskly_loss = losses_dict["TverskyLoss"](y_preds, masks)
+            losses = bce_loss + tverskly_loss
+        scaler.scale(losses).backward()
+        scaler.step(optimizer)
+        scaler.update()
+        losses_all += losses.item() / images.shape[0]
+        bce_all += bce_loss.item() / images.shape[0]
+        tverskly_all += tverskly_loss.item() / images.shape[0]
+    return losses_all, bce_all, tverskly_all
+
+def sync(CFG):
+    if torch.device(CFG.device).type == 'cuda':
+        torch.cuda.synchronize()
+
+def bench(train_fn, batches, CFG):
+    model = script.build_model(CFG, test_flag=True)
+    optimizer = torch.optim.AdamW(model.parameters(), lr=CFG.lr)
+    losses_dict = script.build_loss()
+    train_fn(model, batches[:2], optimizer, losses_dict, CFG) # warm up (cudnn autotune, allocator)
+    sync(CFG)
+    epoch_times = []
+    for _ in range(CFG.repeat):
+        start_time = time.perf_counter()
+        train_fn(model, batches, optimizer, losses_dict, CFG)
+        sync(CFG)
+        epoch_times.append(time.perf_counter() - start_time)
+    return float(np.median(epoch_times)) / len(batches) * 1000
+
+
+if __name__ == '__main__':
+    class CFG:
+        device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        backbone = 'efficientnet-b1'
+        n_25d_shift = 2
+        num_classes = 3
+        img_size = [224, 224]
+        train_bs = 32
+        lr = 1e-3
+
+        n_steps = 50
+        repeat = 3
+        log_intervals = [1, 10, 50, 0] # 0 => one read back per epoch
+        save_path = './bench_loss_sync.csv'
+
+    images = torch.rand(CFG.train_bs, 2*CFG.n_25d_shift+1, *CFG.img_size, device=CFG.device)
+    masks = (torch.rand(CFG.train_bs, CFG.num_classes, *CFG.img_size, device=CFG.device) > 0.9).float()
+    batches = [(images, masks)] * CFG.n_steps
+
+    results = [{"loop": "item per step", "log_interval": 1, "step_ms": bench(item_train_one_epoch, batches, CFG)}]
+    for log_interval in CFG.log_intervals:
+        CFG.log_interval = log_interval
+        CFG.profile_phases = False
+        step_ms = bench(script.train_one_epoch, batches, CFG)
+        results.append({"loop": "on device", "log_interval": log_interval, "step_ms": step_ms})
+    for result in results:
+        print(result, flush=True)
+
+    results = pd.DataFrame(results)
+    results['speedup'] = results.step_ms.iloc[0] / results.step_ms
+    results.to_csv(CFG.save_path, index=False)
+    print(results.to_string(index=False, float_format='{:.2f}'.format), flush=True)
@@ -0,0 +1,52 @@
+###############################################################
+        #  benchmark: row-wise get_metadata/path2info vs vectorized ids2info/paths2info
+        #  run from the repo root: python benchmarks/benchmark_metadata.py
+###############################################################
+
+import os
+import sys
+import time
+import importlib
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+script = importlib.import_module('25D') # file name is not a valid identifier
+
+def synthetic_df(n_case, n_day, n_slice):
+    ids, paths = [], []
+    for case in range(1, n_case+1):
+        for day in range(n_day):
+            for slice_ in range(1, n_slice+1):
+                ids.append(f'case{case}_day{day}_slice_{slice_:04d}')
+                width, height = (266, 266) if case % 2 else (360, 310)
+                paths.append(f'../input/uw-madison-gi-tract-image-segmentation/train/case{case}/case{case}_day{day}/scans/'
+                             f'slice_{slice_:04d}_{width}_{height}_1.50_1.50.png')
+    return pd.DataFrame({'id': ids}), pd.DataFrame({'image_path': paths})
+
+def timeit(fn, *args, repeat=3):
+    best = float('inf')
+    for _ in range(repeat):
+        start_time = time.time()
+        out = fn(*args)
+        best = min(best, time.time() - start_time)
+    return out, best
+
+
+if __name__ == '__main__':
+    class CFG:
+        n_case = 20 # 85 => ~36k rows, the size of the train scan tree (the row-wise apply then takes minutes)
+        n_day = 3
+        n_slice = 144
+
+    sub_df, path_df = synthetic_df(CFG.n_case, CFG.n_day, CFG.n_slice)
+
+    old_sub, old_time = timeit(lambda df: df.apply(script.get_metadata, axis=1), sub_df, repeat=1)
+    new_sub, new_time = timeit(script.ids2info, sub_df)
+    assert (old_sub[['case','day','slice']].astype('int64').values == new_sub[['case','day','slice']].astype('int64').values).all()
+    print("ids   {:>6} rows: apply {:.3f}s, vectorized {:.3f}s, x{:.1f}".format(len(sub_df), old_time, new_time, old_time/new_time), flush=True)
+
+    cols = ['height', 'width', 'case', 'day', 'slice']
+    old_path, old_time = timeit(lambda df: df.apply(script.path2info, axis=1), path_df, repeat=1)
+    new_path, new_time = timeit(script.paths2info, path_df)
+    assert (old_path[cols].astype('int64').values == new_path[cols].astype('int64').values).all()
+    print("paths {:>6} rows: apply {:.3f}s, vectorized {:.3f}s, x{:.1f}".format(len(path_df), old_time, new_time, old_time/new_time), flush=True)
@@ -0,0 +1,103 @@
+###############################################################
+        #  benchmark: per-slice time to get the float32 [0, 1] training mask
+        #  npy tree (np.load + /255) vs MaskStore (pack_masks.py) vs
+        #  rle_decode_batch on the train.csv rles, per slice and per volume,
+        #  vs the python rle_decode loop of Predict_more.ipynb
+        #  also the disk footprint of each source, and checks they all agree
+        #  run from the repo root: python benchmarks/benchmark_rle_decode.py
+###############################################################
+
+import os
+import sys
+import time
+import importlib
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+script = importlib.import_module('25D') # file name is not a valid identifier
+from pack_masks import pack_masks
+from benchmark_dataloader import make_scan_tree
+
+def loop_rle_decode(mask_rle, shape):
+    # Predict_more.ipynb, one class at a time
+    s = np.array(mask_rle.split(), dtype=int)
+    starts, lengths = s[0::2] - 1, s[1::2]
+    ends = starts + lengths
+    mask = np.zeros((shape[0] * shape[1],), dtype=np.uint8)
+    for lo, hi in zip(starts, ends):
+        mask[lo : hi] = 1
+    return mask.reshape(shape)
+
+def npy_load(row):
+    mask = np.load(row.mask_path).astype('float32')
+    mask /= 255.0
+    return mask
+
+def loop_load(row):
+    return np.stack([loop_rle_decode(rle, (row.height, row.width)) for rle in row.segmentation], axis=2).astype('float32')
+
+def time_per_slice_us(fn, rows, repeat):
+    times = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        for row in rows:
+            fn(row)
+        times.append(time.perf_counter() - start_time)
+    return float(np.median(times)) / len(rows) * 1e6
+
+def dir_mbytes(paths):
+    return sum(os.path.getsize(path) for path in paths) / 1024**2
+
+
+if __name__ == '__main__':
+    class CFG:
+        root = './bench_scan_tree'
+        n_case = 4
+        n_day = 2
+        n_slice = 80
+        mask_store = './bench_mask_store'
+        repeat = 3
+        save_path = './bench_rle_decode.csv'
+
+    df = make_scan_tree(CFG.root, CFG.n_case, CFG.n_day, CFG.n_slice)
+    pack_masks(f'{CFG.root}/np', CFG.mask_store)
+    mask_store = script.MaskStore(CFG.mask_store)
+
+    ##### train.csv-like rles, encoded from the npy tree
+    masks = [np.load(path) for path in df.mask_path]
+    df['height'] = [mask.shape[0] for mask in masks]
+    df['width'] = [mask.shape[1] for mask in masks]
+    df['segmentation'] = [script.rle_encode_batch(mask[None]) for mask in masks]
+    df['volume'] = df.case.astype(str) + '_' + df.day.astype(str)
+    rows = list(df.itertuples())
+
+    ##### every source must give the same mask
+    for row in rows:
+        mask = npy_load(row)
+        assert np.array_equal(mask, mask_store.load(row.mask_path))
+        assert np.array_equal(mask, script.rle_decode_batch([row.segmentation], row.height, row.width)[0])
+        assert np.array_equal(mask, loop_load(row))
+
+    results = [
+        {"source": "npy tree", "us_per_slice": time_per_slice_us(npy_load, rows, CFG.repeat)},
+        {"source": "mask store", "us_per_slice": time_per_slice_us(lambda row: mask_store.load(row.mask_path), rows, CFG.repeat)},
+        {"source": "rle loop", "us_per_slice": time_per_slice_us(loop_load, rows, CFG.repeat)},
+        {"source": "rle batch, per slice",
+         "us_per_slice": time_per_slice_us(lambda row: script.rle_decode_batch([row.segmentation], row.height, row.width), rows, CFG.repeat)},
+    ]
+    volumes = [(volume_df.segmentation.tolist(), volume_df.height.iloc[0], volume_df.width.iloc[0]) for _, volume_df in df.groupby('volume')]
+    per_volume_us = time_per_slice_us(lambda volume: script.rle_decode_batch(*volume), volumes, CFG.repeat) * len(volumes) / len(rows)
+    results.append({"source": "rle batch, per volume", "us_per_slice": per_volume_us})
+
+    disk_mb = {"npy tree": dir_mbytes(df.mask_path),
+               "mask store": dir_mbytes([f'{CFG.mask_store}/{name}' for name in os.listdir(CFG.mask_store)]),
+               "rle": df.segmentation.map(lambda rles: sum(len(rle)+1 for rle in rles)).sum() / 1024**2}
+    for result in results:
+        result["disk_mb"] = disk_mb[result["source"].split(',')[0].replace('rle batch', 'rle').replace('rle loop', 'rle')]
+        print(result, flush=True)
+
+    results = pd.DataFrame(results)
+    results['speedup'] = results.us_per_slice.iloc[0] / results.us_per_slice
+    results.to_csv(CFG.save_path, index=False)
+    print(results.to_string(index=False, float_format='{:.2f}'.format), flush=True)
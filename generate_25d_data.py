@@ -0,0 +1,112 @@
+###############################################################
+        #  2.5D train data of generate_2.5d_data.ipynb (part1), one shard per case/day
+        #  input : uwmgi-mask-dataset train.csv (image_path & mask_path per class row)
+        #  output: {out_dir}/images/case*_day*.npy  [n_slice, h, w, channels] uint16, channel i = slice +i*stride
+        #          {out_dir}/masks/case*_day*.npy   [n_slice, h, w, 3] uint8
+        #          {out_dir}/index/case*_day*.csv   id -> row, written last: a volume with it is done
+        #          {out_dir}/index.csv              all volumes
+        #  volumes run in a process pool; a rerun skips the volumes already written
+###############################################################
+
+import os
+import time
+import numpy as np
+import pandas as pd
+import cv2
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from tqdm import tqdm
+
+def load_img(path, size):
+    img = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+    shape0 = np.array(img.shape[:2])
+    resize = np.array(size)
+    if np.any(shape0!=resize):
+        diff = resize - shape0
+        pad0 = diff[0]
+        pad1 = diff[1]
+        pady = [pad0//2, pad0//2 + pad0%2]
+        padx = [pad1//2, pad1//2 + pad1%2]
+        img = np.pad(img, [pady, padx])
+        img = img.reshape(tuple(resize))
+    return img
+
+def load_msk(path, size):
+    msk = np.load(path)
+    shape0 = np.array(msk.shape[:2])
+    resize = np.array(size)
+    if np.any(shape0!=resize):
+        diff = resize - shape0
+        pad0 = diff[0]
+        pad1 = diff[1]
+        pady = [pad0//2, pad0//2 + pad0%2]
+        padx = [pad1//2, pad1//2 + pad1%2]
+        msk = np.pad(msk, [pady, padx, [0,0]])
+        msk = msk.reshape((*resize, 3))
+    return msk
+
+def load_train_df(train_csv_path):
+    # one row per id, in csv order (the 2.5d neighbours follow it)
+    df = pd.read_csv(train_csv_path)
+    df['image_path'] = df.image_path.str.replace('/kaggle/','../')
+    df['mask_path'] = df.mask_path.str.replace('/kaggle/','../')
+    df['mask_path'] = df.mask_path.str.replace('/png/','/np').str.replace('.png','.npy')
+    df = df.groupby(['id']).head(1).reset_index(drop=True)
+    df['volume'] = 'case' + df.case.astype(str) + '_day' + df.day.astype(str)
+    return df[['id', 'volume', 'image_path', 'mask_path']]
+
+def generate_volume(volume, ids, image_paths, mask_paths, out_dir, img_size, channels, stride):
+    n_slice = len(ids)
+    ##### every png decoded once, then the stacks are gathered from the volume
+    slices = np.stack([load_img(path, img_size) for path in image_paths]) # [n_slice, h, w]
+    rows = np.arange(n_slice)
+    images = np.zeros((n_slice, *img_size, channels), dtype=np.uint16)
+    for i in range(channels):
+        ##### == groupby(['case','day']).shift(-i*stride).fillna(method="ffill"): past the last slice, repeat it
+        images[..., i] = slices[np.minimum(rows + i*stride, n_slice-1)]
+    masks = np.stack([load_msk(path, img_size) for path in mask_paths]) # [n_slice, h, w, 3]
+
+    ##### write to tmp files & rename, so an interrupted volume is redone, never half read
+    for sub_dir, array in [('images', images), ('masks', masks)]:
+        np.save(f'{out_dir}/{sub_dir}/{volume}.tmp.npy', array)
+        os.replace(f'{out_dir}/{sub_dir}/{volume}.tmp.npy', f'{out_dir}/{sub_dir}/{volume}.npy')
+    index = pd.DataFrame({"id": ids, "volume": volume, "row": rows})
+    index.to_csv(f'{out_dir}/index/{volume}.tmp.csv', index=False)
+    os.replace(f'{out_dir}/index/{volume}.tmp.csv', f'{out_dir}/index/{volume}.csv')
+    return n_slice
+
+def generate_25d_data(df, out_dir, img_size, channels=3, stride=2, n_worker=None):
+    for sub_dir in ['images', 'masks', 'index']:
+        os.makedirs(f'{out_dir}/{sub_dir}', exist_ok=True)
+
+    volumes = [(volume, volume_df) for volume, volume_df in df.groupby('volume', sort=False)]
+    todo = [(volume, volume_df) for volume, volume_df in volumes if not os.path.exists(f'{out_dir}/index/{volume}.csv')]
+    print("{} volumes, {} already written".format(len(volumes), len(volumes)-len(todo)), flush=True)
+
+    start_time = time.time()
+    n_done = 0
+    with ProcessPoolExecutor(max_workers=n_worker) as executor:
+        futures = [executor.submit(generate_volume, volume, volume_df.id.tolist(), volume_df.image_path.tolist(),
+                                   volume_df.mask_path.tolist(), out_dir, img_size, channels, stride)
+                   for volume, volume_df in todo]
+        pbar = tqdm(as_completed(futures), total=len(futures), desc='Generate ')
+        for future in pbar:
+            n_done += future.result()
+            pbar.set_postfix(slices=n_done, slices_per_sec='{:.1f}'.format(n_done / (time.time() - start_time)))
+
+    index = pd.concat([pd.read_csv(f'{out_dir}/index/{volume}.csv') for volume, _ in volumes], ignore_index=True)
+    index.to_csv(f'{out_dir}/index.csv', index=False)
+    print("wrote {} slices in {:.1f}s".format(n_done, time.time() - start_time), flush=True)
+    return index
+
+
+if __name__ == '__main__':
+    class CFG:
+        train_csv = '../input/uwmgi-mask-dataset/train.csv'
+        out_dir = '../input/tmp/25d'
+        img_size = [320, 384]
+        channels = 3
+        stride = 2
+        n_worker = None # None => os.cpu_count()
+
+    df = load_train_df(CFG.train_csv)
+    index = generate_25d_data(df, CFG.out_dir, CFG.img_size, CFG.channels, CFG.stride, CFG.n_worker)
@@ -13,16 +13,21 @@ import cv2
 import time
 import glob
 import random
+import multiprocessing as mp
+import csv
+import hashlib
+import json
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 from cv2 import transform
-import cupy as cp # https://cupy.dev/ => pip install cupy-cuda102
 import numpy as np
 import pandas as pd
 from glob import glob
 from tqdm import tqdm
 
 import torch 
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, IterableDataset, DataLoader, get_worker_info, Sampler
 from torch.cuda import amp
 
 from sklearn.model_selection import StratifiedGroupKFold 
@@ -66,51 +71,204 @@ def path2info(row):
     # row['id'] = f'case{case}_day{day}_slice_{slice_}'
     return row
 
+def ids2info(df):
+    # vectorized get_metadata over the whole id column, eg: 'case123_day20_slice_0001'
+    info = df['id'].str.extract(r'^case(\d+)_day(\d+)_slice_(\d+)$')
+    info.columns = ['case', 'day', 'slice']
+    return df.assign(**{col: pd.to_numeric(info[col]).astype('Int64') for col in info.columns})
+
+def paths2info(df):
+    # vectorized path2info over the whole image_path column,
+    # eg: '.../case123/case123_day20/scans/slice_0001_266_266_1.50_1.50.png'
+    info = df['image_path'].str.extract(r'case(\d+)_day(\d+)[/\\]scans[/\\]slice_(\d+)_(\d+)_(\d+)_[^/\\]*$')
+    info.columns = ['case', 'day', 'slice', 'width', 'height']
+    return df.assign(**{col: pd.to_numeric(info[col]).astype('Int64') for col in ['height', 'width', 'case', 'day', 'slice']})
+
+def rle_encode_batch(msks):
+    '''
+    msks: numpy array [n, h, w, c], 1 - mask, 0 - background
+    Returns n*c run length strings (image by image, class by class), same format as mask2rle
+    '''
+    n, h, w, c = msks.shape
+    pixels = np.ascontiguousarray(msks.transpose(0, 3, 1, 2)).reshape(n*c, h*w) != 0 # one row per mask
+    pixels = np.pad(pixels, ((0, 0), (1, 1))) # pad 0 at both ends of every row
+    edges = np.flatnonzero(pixels[:, 1:] != pixels[:, :-1]) # index into the flattened [n*c, h*w+1] edge map
+    counts = np.diff(np.searchsorted(edges, np.arange(n*c+1) * (h*w+1))) # edges per row
+    runs = (edges - np.repeat(np.arange(n*c) * (h*w+1), counts) + 1).astype(np.int32)
+    runs[1::2] -= runs[::2] # every row has an even number of edges, so start/length pairs never straddle two rows
+
+    ##### format all numbers at once: right-aligned ascii digits + ' ', then drop the leading padding
+    n_digits = len(str(h*w+1))
+    chars = np.full((len(runs), n_digits+1), ord(' '), dtype=np.uint8)
+    widths = np.zeros(len(runs), dtype=np.int32)
+    rest = runs.copy()
+    for col in range(n_digits-1, -1, -1):
+        chars[:, col] = rest % 10 + ord('0')
+        widths += (rest > 0) | (col == n_digits-1)
+        rest //= 10
+    text = chars[np.arange(n_digits+1) >= (n_digits - widths)[:, None]].tobytes()
+    ends = np.cumsum(np.bincount(np.repeat(np.arange(n*c), counts), weights=widths+1, minlength=n*c)).astype(np.int64).tolist()
+    starts = [0] + ends[:-1]
+    return [text[start:end-1].decode() if end > start else '' for start, end in zip(starts, ends)]
+
 def mask2rle(msk, thr=0.5):
     '''
     img: numpy array, 1 - mask, 0 - background
     Returns run length as string formated
     '''
-    msk    = cp.array(msk)
-    pixels = msk.flatten()
-    pad    = cp.array([0])
-    pixels = cp.concatenate([pad, pixels, pad])
-    runs   = cp.where(pixels[1:] != pixels[:-1])[0] + 1
-    runs[1::2] -= runs[::2]
-    return ' '.join(str(x) for x in runs)
+    return rle_encode_batch(msk[None, :, :, None])[0]
+
+def rle_decode_batch(rles, height, width):
+    '''
+    rles: n lists of c run length strings ('' or NaN - empty), same format as mask2rle
+    Returns float32 numpy array [n, h, w, c], 1 - mask, 0 - background
+    '''
+    n, c = len(rles), len(rles[0]) if len(rles) else 0
+    tokens = [rle.split() if isinstance(rle, str) else [] for image_rles in rles for rle in image_rles]
+    runs = np.array([token for rle_tokens in tokens for token in rle_tokens], dtype=np.int64).reshape(-1, 2) # [start, length]
+    masks = np.repeat(np.arange(n*c), [len(rle_tokens)//2 for rle_tokens in tokens]) # image*c + class of every run
+
+    ##### every pixel of every run at once: run start repeated run length times + its offset inside the run
+    starts, lengths = runs[:, 0]-1, runs[:, 1]
+    pixels = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+    masks = np.repeat(masks, lengths)
+    decoded = np.zeros((n, height, width, c), dtype='float32')
+    decoded.reshape(-1)[(masks//c*height*width + pixels)*c + masks%c] = 1
+    return decoded
 
 def masks2rles(msks, ids, heights, widths):
     pred_strings = []; pred_ids = []; pred_classes = [];
+    ##### back to original shape, then encode all images of the same shape in one pass
+    shape_groups = {}
     for idx in range(msks.shape[0]):
         height = heights[idx].item()
         width = widths[idx].item()
         msk = cv2.resize(msks[idx], 
                         dsize=(width, height), 
                         interpolation=cv2.INTER_NEAREST) # back to original shape
-        rle = [None]*3
-        for midx in [0, 1, 2]:
-            rle[midx] = mask2rle(msk[...,midx])
-        pred_strings.extend(rle)
-        pred_ids.extend([ids[idx]]*len(rle))
+        shape_groups.setdefault((height, width), []).append((idx, msk))
+
+    rles = [None]*msks.shape[0]
+    for group in shape_groups.values():
+        group_rles = rle_encode_batch(np.stack([msk for _, msk in group])) # [n, h, w, 3] => n*3 rles
+        for i, (idx, _) in enumerate(group):
+            rles[idx] = group_rles[3*i:3*i+3]
+
+    for idx in range(msks.shape[0]):
+        pred_strings.extend(rles[idx])
+        pred_ids.extend([ids[idx]]*len(rles[idx]))
         pred_classes.extend(['large_bowel', 'small_bowel', 'stomach'])
     return pred_strings, pred_ids, pred_classes
 
+class SubmissionWriter:
+    """
+    stream predictions into the submission csv in the order of the submission template.
+    a row is written once every row before it in the template is known, and the file is
+    flushed after every batch, so a crash leaves a shorter but still valid csv.
+    """
+    def __init__(self, save_path, template_df):
+        self.template = list(zip(template_df['id'], template_df['class'])) # submission order
+        self.cursor = 0
+        self.pending = {} # {(id, class): rle}, predictions that arrived ahead of the template order
+        self.file = open(save_path, 'w', newline='')
+        self.writer = csv.writer(self.file, lineterminator='\n') # same line ending as DataFrame.to_csv
+        self.writer.writerow(['id', 'class', 'predicted'])
+        self.file.flush()
+
+    def write(self, pred_strings, pred_ids, pred_classes):
+        self.pending.update(zip(zip(pred_ids, pred_classes), pred_strings))
+        rows = []
+        while self.cursor < len(self.template) and self.template[self.cursor] in self.pending:
+            id_, class_ = self.template[self.cursor]
+            rows.append([id_, class_, self.pending.pop((id_, class_))])
+            self.cursor += 1
+        self.writer.writerows(rows)
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+        if self.cursor < len(self.template):
+            print("submission: {} of {} rows written".format(self.cursor, len(self.template)), flush=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def generate_train_df(train_csv_path):
+    # document: https://pandas.pydata.org/docs/reference/frame.html
+    df = pd.read_csv(train_csv_path)
+    df['segmentation'] = df.segmentation.fillna('') 
+    # rle mask length
+    df['rle_len'] = df.segmentation.map(len) 
+    # image/mask path
+    df['image_path'] = df.image_path.str.replace('/kaggle/','../')
+    df['mask_path'] = df.mask_path.str.replace('/kaggle/','../')
+    df['mask_path'] = df.mask_path.str.replace('/png/','/np').str.replace('.png','.npy')
+
+    # rle list of each id
+    df2 = df.groupby(['id'])['segmentation'].agg(list).to_frame().reset_index() 
+    # total length of all rles of each id
+    df2 = df2.merge(df.groupby(['id'])['rle_len'].agg(sum).to_frame().reset_index()) 
+    df = df.drop(columns=['segmentation', 'class', 'rle_len']) 
+    df = df.groupby(['id']).head(1).reset_index(drop=True)
+    # empty mask
+    df = df.merge(df2, on=['id']) 
+    df['empty'] = (df.rle_len==0)
+    return df
+
+def file_hash(path, chunk_size=1<<20):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+def add_slice_neighbors(df):
+    ##### image_path of the slice right below / above in the same case/day, missing at the volume ends
+    if 'case' not in df.columns:
+        df = ids2info(df)
+    keys = df[['case', 'day', 'slice', 'image_path']]
+    for name, offset in (('prev_path', -1), ('next_path', 1)):
+        neighbors = keys.assign(slice=keys.slice - offset).rename(columns={'image_path': name})
+        df = df.merge(neighbors, on=['case', 'day', 'slice'], how='left') # keeps the row order
+    return df
+
+def load_train_index(train_csv_path, CFG):
+    """
+    generate_train_df() + slice neighbours + StratifiedGroupKFold folds, cached as parquet under
+    CFG.index_cache keyed on the csv's sha1 and the fold parameters; later runs only read the parquet.
+    CFG.index_cache = None => rebuilt every run.
+    """
+    cache_path = None
+    if CFG.index_cache:
+        cache_path = f"{CFG.index_cache}/train_{file_hash(train_csv_path)[:16]}_fold{CFG.n_fold}_seed{CFG.seed}.parquet"
+        if os.path.isfile(cache_path):
+            df = pd.read_parquet(cache_path)
+            df['segmentation'] = df.segmentation.map(list) # parquet gives arrays back
+            return df
+
+    df = generate_train_df(train_csv_path)
+    df = add_slice_neighbors(df)
+    # document: http://scikit-learn.org/stable/modules/generated/sklearn.model_selection.StratifiedGroupKFold.html
+    skf = StratifiedGroupKFold(n_splits=CFG.n_fold, shuffle=True, random_state=CFG.seed)
+    for fold, (train_idx, val_idx) in enumerate(skf.split(df, df['empty'], groups = df["case"])):
+        df.loc[val_idx, 'fold'] = fold
+
+    if cache_path is not None:
+        os.makedirs(CFG.index_cache, exist_ok=True)
+        df.to_parquet(f"{cache_path}.tmp", index=False)
+        os.replace(f"{cache_path}.tmp", cache_path)
+    return df
+
 ###############################################################
 #part1: build_transforms & build_dataset & build_dataloader
 ###############################################################
 def build_transforms(CFG):
     data_transforms = {
         "train": A.Compose([
-            A.OneOf([
-                A.Resize(*[224, 224], interpolation=cv2.INTER_NEAREST, p=1.0),
-                A.Resize(*[256, 256], interpolation=cv2.INTER_NEAREST, p=1.0),
-                A.Resize(*[288, 288], interpolation=cv2.INTER_NEAREST, p=1.0),
-                A.Resize(*[320, 320], interpolation=cv2.INTER_NEAREST, p=1.0),
-                A.Resize(*[352, 352], interpolation=cv2.INTER_NEAREST, p=1.0),
-                A.Resize(*[384, 384], interpolation=cv2.INTER_NEAREST, p=1.0),
-                A.Resize(*CFG.img_size, interpolation=cv2.INTER_NEAREST, p=1.0),
-            ], p=1),
-
+            # multi-resolution resize: one of CFG.train_img_sizes per batch, see ResolutionBatchSampler
             A.HorizontalFlip(p=0.5),
             # A.VerticalFlip(p=0.5),
             A.ShiftScaleRotate(shift_limit=0.0625, scale_limit=0.05, rotate_limit=10, p=0.5),
@@ -128,8 +286,152 @@ def build_transforms(CFG):
         }
     return data_transforms
 
+class SliceCache:
+    """
+    per-(case, day) cache of decoded scan slices with LRU eviction.
+    neighbouring 2.5d stacks share most of their slices, so every png is decoded once
+    as long as its volume stays inside the byte budget. that holds for the in-order (shuffle=False)
+    valid/test loaders only: a shuffled train loader jumps between volumes and its workers restart
+    empty every epoch, so build_dataloader turns the cache off for train.
+    max_bytes is the total budget: each DataLoader worker holds its own cache, so on first use
+    a worker takes max_bytes // num_workers. the counters sit in shared memory, one row per process
+    (0: main, i+1: worker i), so stats() covers the workers too.
+    """
+    def __init__(self, max_bytes, max_workers=64):
+        self.total_bytes = max_bytes
+        self.max_bytes = None # this process' share, see attach
+        self.counters = torch.zeros((max_workers+1, 4), dtype=torch.int64).share_memory_() # [process, (hits, misses, volumes, bytes)]
+        self.pid = None # process the cache belongs to, see attach
+        self.volumes = OrderedDict() # {'.../case123_day20/scans': {slice_path: img or None}}
+        self.nbytes = 0
+
+    def __getstate__(self):
+        # DataLoader workers start with an empty cache, the shared counters go along
+        state = self.__dict__.copy()
+        state.update(pid=None, volumes=OrderedDict(), nbytes=0, count=None)
+        return state
+
+    def attach(self):
+        # first use in this process: its share of the budget, its counter row, an empty cache
+        worker_info = get_worker_info() # None in the main process
+        num_workers, row = (1, 0) if worker_info is None else (worker_info.num_workers, worker_info.id + 1)
+        assert row < len(self.counters), f"more than {len(self.counters)-1} DataLoader workers"
+        self.max_bytes = self.total_bytes // num_workers
+        self.count = self.counters[row].numpy() # shares the memory of self.counters
+        self.volumes = OrderedDict()
+        self.nbytes = 0
+        self.pid = os.getpid()
+
+    def get(self, img_path):
+        if self.pid != os.getpid(): # forked workers inherit the parent's cache
+            self.attach()
+        volume_key = os.path.dirname(img_path)
+        volume = self.volumes.get(volume_key)
+        if volume is None:
+            volume = self.volumes[volume_key] = {}
+        self.volumes.move_to_end(volume_key) # mark as most recently used
+
+        if img_path in volume:
+            self.count[0] += 1
+            return volume[img_path]
+
+        self.count[1] += 1
+        if os.path.exists(img_path):
+            img = cv2.imread(img_path, cv2.IMREAD_UNCHANGED) # [w, h]
+        else:
+            img = None # missing neighbours are cached as well, saves the os.path.exists
+        if self.max_bytes > 0:
+            volume[img_path] = img
+            self.nbytes += 0 if img is None else img.nbytes
+            self.evict()
+        else:
+            self.volumes.pop(volume_key)
+        self.count[2] = len(self.volumes)
+        self.count[3] = self.nbytes
+        return img
+
+    def evict(self):
+        # drop whole volumes, least recently used first, but never the one in use
+        while self.nbytes > self.max_bytes and len(self.volumes) > 1:
+            _, volume = self.volumes.popitem(last=False)
+            self.nbytes -= sum(img.nbytes for img in volume.values() if img is not None)
+
+    def reset(self):
+        self.counters.zero_()
+
+    def stats(self):
+        # summed over the main process & every worker since the last reset, volumes & mbytes as last seen
+        hits, misses, volumes, nbytes = self.counters.sum(dim=0).tolist()
+        return {"hits": hits, "misses": misses, "hit_rate": hits / max(hits + misses, 1),
+                "volumes": volumes, "mbytes": nbytes / 1024**2, "max_mbytes": self.total_bytes / 1024**2}
+
+class VolumeStore:
+    """
+    read side of pack_volumes.py: one uint16 memmap per case/day + index.csv.
+    a 2.5d stack of neighbouring slices is a zero-copy view of the memmap, and all
+    DataLoader workers share the same page cache instead of opening thousands of pngs.
+    """
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        index = pd.read_csv(f'{store_dir}/index.csv')
+        self.positions = dict(zip(zip(index.volume, index.slice), index.position)) # {(volume, slice): row}
+        self.volumes = {} # opened lazily, so every worker maps the files itself
+
+    def __getstate__(self):
+        # never pickle opened memmaps into DataLoader workers
+        state = self.__dict__.copy()
+        state['volumes'] = {}
+        return state
+
+    def get_volume(self, volume):
+        if volume not in self.volumes:
+            self.volumes[volume] = np.load(f'{self.store_dir}/{volume}.npy', mmap_mode='r') # [n, w, h]
+        return self.volumes[volume]
+
+    def load_stack(self, middle_img_path, n_25d_shift):
+        volume = os.path.basename(os.path.dirname(os.path.dirname(middle_img_path))) # eg: case123_day20
+        middle_slice_num = int(os.path.basename(middle_img_path).split('_')[1])
+
+        ##### same rule as the png path: a missing slice is filled by its inner neighbour
+        positions = [None]*(2*n_25d_shift+1)
+        positions[n_25d_shift] = self.positions.get((volume, middle_slice_num))
+        if positions[n_25d_shift] is None:
+            return None # not packed (eg: the test scans), the caller reads the pngs
+        for related_idx in range(1, n_25d_shift+1):
+            left = self.positions.get((volume, middle_slice_num-related_idx))
+            right = self.positions.get((volume, middle_slice_num+related_idx))
+            positions[n_25d_shift-related_idx] = left if left is not None else positions[n_25d_shift-related_idx+1]
+            positions[n_25d_shift+related_idx] = right if right is not None else positions[n_25d_shift+related_idx-1]
+
+        packed = self.get_volume(volume)
+        if positions == list(range(positions[0], positions[-1]+1)):
+            stack = packed[positions[0]:positions[-1]+1] # zero-copy view
+        else:
+            stack = packed[positions] # volume border, copies
+        return stack.transpose(1, 2, 0) # [c, w, h] => [w, h, c]
+
+class MaskStore(VolumeStore):
+    """
+    read side of pack_masks.py: the 0/255 [h, w, 3] masks bit-packed to 1 bit per pixel & class,
+    one memmap per case/day + index.csv. a slice is unpacked straight into the float32 [0, 1]
+    mask the augmentations take, with 1/8 of the bytes of the npy tree to read.
+    """
+    def __init__(self, store_dir):
+        super().__init__(store_dir)
+        index = pd.read_csv(f'{store_dir}/index.csv')
+        self.shapes = dict(zip(index.volume, zip(index.height, index.width))) # {volume: (h, w)}
+
+    def load(self, mask_path):
+        #### eg: mask_path: '.../case123/case123_day20/scans/slice_0001.npy'
+        volume = os.path.basename(os.path.dirname(os.path.dirname(mask_path))) # eg: case123_day20
+        slice_num = int(os.path.basename(mask_path)[:-4].split('_')[1])
+        height, width = self.shapes[volume]
+        bits = self.get_volume(volume)[self.positions[(volume, slice_num)]] # [h, ceil(w*3/8)]
+        mask = np.unpackbits(bits, axis=-1, count=width*3).reshape(height, width, 3)
+        return mask.astype('float32')
+
 class build_dataset(Dataset):
-    def __init__(self, df, label=True, transforms=None, cfg=None):
+    def __init__(self, df, label=True, transforms=None, cfg=None, slice_cache=True):
         self.df = df
         self.label = label
         self.img_paths = df['image_path'].tolist() # image
@@ -142,11 +444,21 @@ class build_dataset(Dataset):
 
         self.transforms = transforms
         self.n_25d_shift = cfg.n_25d_shift
+        self.slice_cache = SliceCache(cfg.slice_cache_mb * 1024**2 if slice_cache else 0) # off => counts the misses only
+        self.volume_store = VolumeStore(cfg.volume_store) if cfg.volume_store else None
+        self.mask_store = MaskStore(cfg.mask_store) if cfg.mask_store else None
+        self.rles = df['segmentation'].tolist() if cfg.mask_from_rle else None # decoded on the fly
+        self.resizes = {} # {img_size: A.Resize}, for indices coming from ResolutionBatchSampler
 
     def __len__(self):
         return len(self.df)
     
     def __getitem__(self, index):
+        #### ResolutionBatchSampler passes (index, img_size), img_size is shared by the whole batch
+        img_size = None
+        if isinstance(index, tuple):
+            index, img_size = index
+
         #### load id
         id       = self.ids[index]
         #### load image
@@ -156,9 +468,22 @@ class build_dataset(Dataset):
         
         if self.label: # train
             #### load mask
-            mask_path = self.mask_paths[index]
-            mask = np.load(mask_path).astype('float32')
-            mask/=255.0 # scale mask to [0, 1]
+            if self.rles is not None:
+                mask = rle_decode_batch([self.rles[index]], h, w)[0] # already in [0, 1]
+            elif self.mask_store is not None:
+                mask = self.mask_store.load(self.mask_paths[index]) # already in [0, 1]
+            else:
+                mask_path = self.mask_paths[index]
+                mask = np.load(mask_path).astype('float32')
+                mask/=255.0 # scale mask to [0, 1]
+
+            ### resize to the resolution of this batch
+            if img_size is not None:
+                if img_size not in self.resizes:
+                    self.resizes[img_size] = A.Resize(*img_size, interpolation=cv2.INTER_NEAREST)
+                data = self.resizes[img_size](image=img, mask=mask)
+                img  = data['image']
+                mask  = data['mask']
 
             ### augmentations
             data = self.transforms(image=img, mask=mask)
@@ -179,11 +504,18 @@ class build_dataset(Dataset):
     #construct 2.5d slice images
     ###############################################################
     def load_2_5d_slice(self, middle_img_path):
+        new_25d_imgs = None if self.volume_store is None else self.volume_store.load_stack(middle_img_path, self.n_25d_shift)
+        if new_25d_imgs is not None:
+            new_25d_imgs = new_25d_imgs.astype('float32') # [w, h, c]
+            mx_pixel = new_25d_imgs.max()
+            if mx_pixel != 0:
+                new_25d_imgs /= mx_pixel
+            return new_25d_imgs
+
         #### step1: capture info from the middle image
         #### eg: middle_img_path: 'slice_0005_266_266_1.50_1.50.png' 
         middle_slice_num = os.path.basename(middle_img_path).split('_')[1] # eg: 0005
         middle_str = 'slice_'+middle_slice_num
-        middle_img = cv2.imread(middle_img_path, cv2.IMREAD_UNCHANGED)
 
         new_25d_imgs = []
 
@@ -194,11 +526,8 @@ class build_dataset(Dataset):
             shift_str = 'slice_'+str(shift_slice_num).zfill(4)
             shift_img_path = middle_img_path.replace(middle_str, shift_str)
             
-            if os.path.exists(shift_img_path):
-                shift_img = cv2.imread(shift_img_path, cv2.IMREAD_UNCHANGED) # [w, h]
-                new_25d_imgs.append(shift_img)
-            else:
-                new_25d_imgs.append(None)
+            shift_img = self.slice_cache.get(shift_img_path) # [w, h], None if no such slice
+            new_25d_imgs.append(shift_img)
         
         ##### step3：Loop from the center to the outside, fill in the value of None in turn
         ##### eg: n_25d_shift = 2, then form 5 channel, idx is [0, 1, 2, 3, 4], so the idx processed in turn is [1, 3, 0, 4]
@@ -220,43 +549,98 @@ class build_dataset(Dataset):
             new_25d_imgs /= mx_pixel
         return new_25d_imgs
 
-def _max_by_axis(the_list):
-    maxes = the_list[0]
-    for sublist in the_list[1:]:
-        for index, item in enumerate(sublist):
-            maxes[index] = max(maxes[index], item)
-    return maxes
-
-def collate_fn(batch):
-    # make it support different-sized images
-    batch = list(zip(*batch))
-    img_list = batch[0]
-    mask_list = batch[1]
-    max_size = _max_by_axis([list(img.shape) for img in img_list])
-    batch_shape = [len(img_list)] + max_size
-    b, c, h, w = batch_shape
-    dtype = img_list[0].dtype
-    device = img_list[0].device
-    pad_imgs = torch.zeros(batch_shape, dtype=dtype, device=device) # [b, c, w, h]
-    pad_masks = torch.zeros(batch_shape, dtype=dtype, device=device) # [b, c, w, h]
-    for img, mask, pad_img, pad_mask in zip(img_list, mask_list, pad_imgs, pad_masks):
-            # img/pad_img:[c, w, h]
-            pad_img[:img.shape[0], :img.shape[1], :img.shape[2]].copy_(img)
-            pad_mask[:img.shape[0], :img.shape[1], :img.shape[2]].copy_(mask)
-    return [pad_imgs, pad_masks]
+class ResolutionBatchSampler(Sampler):
+    """
+    multi-resolution training without padding: shuffle like DataLoader(shuffle=True),
+    cut into batches, then draw one resize resolution per batch, so every sample of a
+    batch has the same shape and the default collate just stacks them.
+    runs in the main process, so it works with any num_workers.
+    """
+    def __init__(self, n_samples, batch_size, img_sizes, shuffle=True, drop_last=False):
+        self.n_samples = n_samples
+        self.batch_size = batch_size
+        self.img_sizes = [tuple(img_size) for img_size in img_sizes]
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+
+    def __iter__(self):
+        order = torch.randperm(self.n_samples).tolist() if self.shuffle else list(range(self.n_samples))
+        for start in range(0, self.n_samples, self.batch_size):
+            batch = order[start:start+self.batch_size]
+            if self.drop_last and len(batch) < self.batch_size:
+                break
+            img_size = self.img_sizes[torch.randint(len(self.img_sizes), (1,)).item()]
+            yield [(idx, img_size) for idx in batch]
+
+    def __len__(self):
+        if self.drop_last:
+            return self.n_samples // self.batch_size
+        return (self.n_samples + self.batch_size - 1) // self.batch_size
 
+class build_volume_dataset(IterableDataset):
+    """
+    test-time dataset in volume order (CFG.volume_infer): each case/day scans dir is decoded once,
+    sorted by slice, and every 2.5d stack is a window over the in-memory volume. the stack max used
+    for normalization comes from per-slice maxima computed once per volume.
+    yields the same (img, id, h, w) as build_dataset(label=False), grouped by volume instead of in df order;
+    DataLoader workers split the volumes between them.
+    """
+    def __init__(self, df, transforms=None, cfg=None):
+        self.df = df
+        self.transforms = transforms
+        self.n_25d_shift = cfg.n_25d_shift
+        scan_dirs = df['image_path'].map(os.path.dirname)
+        self.volumes = [(scan_dir, volume_df['id'].tolist(), volume_df['image_path'].tolist())
+                        for scan_dir, volume_df in df.groupby(scan_dirs, sort=False)]
+
+    def __len__(self):
+        return len(self.df)
+
+    def load_volume(self, scan_dir):
+        ##### every slice of the scan, not only the df rows: neighbours come from disk as in build_dataset
+        slice_paths = sorted(glob(f'{scan_dir}/slice_*.png')) # slice numbers are zero padded
+        volume = np.stack([cv2.imread(slice_path, cv2.IMREAD_UNCHANGED) for slice_path in slice_paths]) # [n, w, h]
+        positions = {int(os.path.basename(slice_path).split('_')[1]): position for position, slice_path in enumerate(slice_paths)}
+        slice_max = volume.reshape(len(volume), -1).max(axis=1).astype('float32') # [n]
+        return volume, positions, slice_max
+
+    def __iter__(self):
+        worker_info = torch.utils.data.get_worker_info()
+        volumes = self.volumes if worker_info is None else self.volumes[worker_info.id::worker_info.num_workers]
+        for scan_dir, ids, img_paths in volumes:
+            volume, positions, slice_max = self.load_volume(scan_dir)
+            for id, img_path in zip(ids, img_paths):
+                middle_slice_num = int(os.path.basename(img_path).split('_')[1])
+                ##### same rule as load_2_5d_slice: a missing slice is filled by its inner neighbour
+                stack_positions = [None]*(2*self.n_25d_shift+1)
+                stack_positions[self.n_25d_shift] = positions[middle_slice_num]
+                for related_idx in range(1, self.n_25d_shift+1):
+                    left = positions.get(middle_slice_num-related_idx)
+                    right = positions.get(middle_slice_num+related_idx)
+                    stack_positions[self.n_25d_shift-related_idx] = left if left is not None else stack_positions[self.n_25d_shift-related_idx+1]
+                    stack_positions[self.n_25d_shift+related_idx] = right if right is not None else stack_positions[self.n_25d_shift+related_idx-1]
+
+                img = volume[stack_positions].transpose(1, 2, 0).astype('float32') # [w, h, c]
+                mx_pixel = slice_max[stack_positions].max()
+                if mx_pixel != 0:
+                    img /= mx_pixel
+                h, w = img.shape[:2]
+
+                ### augmentations
+                data = self.transforms(image=img)
+                img  = data['image']
+                img = np.transpose(img, (2, 0, 1)) # [h, w, c] => [c, h, w]
+                yield torch.tensor(img), id, h, w
 
 def build_dataloader(df, fold, data_transforms, CFG):
     train_df = df.query("fold!=@fold").reset_index(drop=True)
     valid_df = df.query("fold==@fold").reset_index(drop=True)
-    train_dataset = build_dataset(train_df, label=True, transforms=data_transforms['train'], cfg=CFG)
+    train_dataset = build_dataset(train_df, label=True, transforms=data_transforms['train'], cfg=CFG, slice_cache=False) # shuffled, see SliceCache
     valid_dataset = build_dataset(valid_df, label=True, transforms=data_transforms['valid_test'], cfg=CFG)
 
-    # train_loader = DataLoader(train_dataset, batch_size=CFG.train_bs, num_workers=CFG.num_worker, shuffle=True, pin_memory=True, drop_last=False)
-    # valid_loader = DataLoader(valid_dataset, batch_size=CFG.valid_bs, num_workers=CFG.num_worker, shuffle=False, pin_memory=True)
-    
-    train_loader = DataLoader(train_dataset, batch_size=CFG.train_bs, num_workers=0, shuffle=True, pin_memory=True, drop_last=False, collate_fn=collate_fn)
-    valid_loader = DataLoader(valid_dataset, batch_size=CFG.valid_bs, num_workers=0, shuffle=False, pin_memory=True)
+    train_sampler = ResolutionBatchSampler(len(train_dataset), CFG.train_bs, CFG.train_img_sizes, shuffle=True, drop_last=False)
+    train_loader = DataLoader(train_dataset, batch_sampler=train_sampler, num_workers=CFG.num_worker, pin_memory=True)
+    valid_loader = DataLoader(valid_dataset, batch_size=CFG.valid_bs, num_workers=CFG.num_worker, shuffle=False, pin_memory=True)
     return train_loader, valid_loader
 
 ###############################################################
@@ -277,6 +661,16 @@ def build_model(CFG, test_flag=False):
     model.to(CFG.device)
     return model
 
+def build_model_pool(ckpt_paths, CFG):
+    # build & load every checkpoint once per inference run, then reuse it for all batches
+    models = []
+    for sub_ckpt_path in ckpt_paths:
+        model = build_model(CFG, test_flag=True)
+        model.load_state_dict(torch.load(sub_ckpt_path, map_location=CFG.device))
+        model.eval()
+        models.append(model)
+    return models
+
 ###############################################################
 #part3: build_loss <<<<<<
 ###############################################################
@@ -303,70 +697,241 @@ def iou_coef(y_true, y_pred, thr=0.5, dim=(2,3), epsilon=0.001):
     union = (y_true + y_pred - y_true*y_pred).sum(dim=dim)
     iou = ((inter+epsilon)/(union+epsilon)).mean(dim=(1,0))
     return iou
+
+class DiceIoUMeter:
+    """
+    streaming dice/iou of valid_one_epoch: per-(sample, class) scores are summed on device
+    and reduced once in compute(), so every sample weighs the same whatever its batch size.
+    """
+    def __init__(self, num_classes, device, thr=0.5, epsilon=0.001):
+        self.thr = thr
+        self.epsilon = epsilon
+        self.dice_sum = torch.zeros(num_classes, device=device)
+        self.iou_sum = torch.zeros(num_classes, device=device)
+        self.n = 0
+
+    def update(self, y_true, y_pred, dim=(2,3)):
+        y_true = y_true.to(torch.float32)
+        y_pred = (y_pred>self.thr).to(torch.float32)
+        inter = (y_true*y_pred).sum(dim=dim) # [b, c]
+        den = y_true.sum(dim=dim) + y_pred.sum(dim=dim)
+        self.dice_sum += ((2*inter+self.epsilon)/(den+self.epsilon)).sum(dim=0)
+        self.iou_sum += ((inter+self.epsilon)/(den-inter+self.epsilon)).sum(dim=0)
+        self.n += y_true.shape[0]
+
+    def compute(self):
+        ##### the only read back: mean over samples per class, then over classes
+        class_dice = (self.dice_sum / max(self.n, 1)).cpu().numpy()
+        class_iou = (self.iou_sum / max(self.n, 1)).cpu().numpy()
+        return float(class_dice.mean()), float(class_iou.mean()), class_dice
     
+def to_cpu(obj):
+    ##### detached cpu copy of every tensor in a (nested) state dict
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {key: to_cpu(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(value) for value in obj)
+    return obj
+
+class CheckpointWriter:
+    """
+    torch.save on one background thread, files written in submission order.
+    save() snapshots the tensors to cpu first, so training can go on updating them;
+    each file goes to .{name}.tmp next to it and is os.replace()d, a crash never leaves a half-written checkpoint
+    (the dot keeps the temp file out of glob(f'{ckpt_path}/best*')).
+    """
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.futures = []
+
+    def write(self, obj, save_path):
+        tmp_path = os.path.join(os.path.dirname(save_path), f".{os.path.basename(save_path)}.tmp")
+        torch.save(obj, tmp_path)
+        os.replace(tmp_path, save_path)
+
+    def save(self, obj, save_path):
+        for future in [future for future in self.futures if future.done()]:
+            future.result() # re-raise a failed write on the main thread
+            self.futures.remove(future)
+        self.futures.append(self.executor.submit(self.write, to_cpu(obj), save_path))
+
+    def wait(self):
+        for future in self.futures:
+            future.result()
+        self.futures = []
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def training_state(fold, epoch, model, optimizer, lr_scheduler, scaler, best_val_dice, best_epoch):
+    ##### everything needed to continue a fold after its epoch-th epoch
+    return {
+        "fold": fold,
+        "epoch": epoch,
+        "best_val_dice": best_val_dice,
+        "best_epoch": best_epoch,
+        "model": model.state_dict(),
+        "optimizer": optimizer.state_dict(),
+        "lr_scheduler": lr_scheduler.state_dict(),
+        "scaler": scaler.state_dict(),
+        "rng": {"torch": torch.get_rng_state(), "numpy": np.random.get_state(), "random": random.getstate(),
+                "cuda": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else []},
+    }
+
+def load_training_state(state, model, optimizer, lr_scheduler, scaler):
+    model.load_state_dict(state["model"])
+    optimizer.load_state_dict(state["optimizer"])
+    lr_scheduler.load_state_dict(state["lr_scheduler"])
+    scaler.load_state_dict(state["scaler"])
+    torch.set_rng_state(state["rng"]["torch"])
+    np.random.set_state(state["rng"]["numpy"])
+    random.setstate(state["rng"]["random"])
+    if torch.cuda.is_available() and state["rng"]["cuda"]:
+        torch.cuda.set_rng_state_all(state["rng"]["cuda"])
+    return state["epoch"], state["best_val_dice"], state["best_epoch"]
+
 ###############################################################
 #part5: train & validation & test <<<<<<
 ###############################################################
-def train_one_epoch(model, train_loader, optimizer, losses_dict, CFG):
+class PhaseTimer:
+    """
+    opt-in per-step timing of train_one_epoch / valid_one_epoch (CFG.profile_phases).
+    mark(phase) charges the time since the previous mark to phase; with cuda it
+    synchronizes first so async kernels are counted in the phase that launched them.
+    disabled => every call returns immediately, nothing is synchronized.
+    """
+    def __init__(self, enabled, device):
+        self.enabled = enabled
+        self.device = torch.device(device)
+        self.times = {}
+        self.n_samples = 0
+        self.start_time = self.last_time = None
+
+    def sync(self):
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+
+    def start(self):
+        if not self.enabled:
+            return
+        self.sync()
+        self.start_time = self.last_time = time.perf_counter()
+
+    def mark(self, phase):
+        if not self.enabled:
+            return
+        self.sync()
+        now = time.perf_counter()
+        self.times.setdefault(phase, []).append(now - self.last_time)
+        self.last_time = now
+
+    def count(self, n):
+        self.n_samples += n
+
+    def summary(self):
+        ##### seconds per step: mean/p50/p95 of each phase
+        summary = {phase: {"mean": float(np.mean(times)), "p50": float(np.percentile(times, 50)),
+                           "p95": float(np.percentile(times, 95)), "total": float(np.sum(times))}
+                   for phase, times in self.times.items()}
+        wall_time = self.last_time - self.start_time if self.start_time is not None else 0
+        summary["steps"] = max([len(times) for times in self.times.values()], default=0)
+        summary["samples_per_sec"] = self.n_samples / wall_time if wall_time > 0 else 0
+        return summary
+
+def save_phase_times(save_path, **timers):
+    os.makedirs(os.path.dirname(save_path), exist_ok=True)
+    with open(save_path, 'w') as f:
+        json.dump({name: timer.summary() for name, timer in timers.items()}, f, indent=2)
+
+def train_one_epoch(model, train_loader, optimizer, losses_dict, CFG, timer=None, scaler=None):
     model.train()
-    scaler = amp.GradScaler() 
-    losses_all, bce_all, tverskly_all = 0, 0, 0
+    scaler = scaler or amp.GradScaler() # pass one in to keep its loss scale across epochs
+    timer = timer or PhaseTimer(False, CFG.device)
+    loss_sums = torch.zeros(3, device=CFG.device) # losses, bce, tverskly: kept on device, no sync per step
     
     pbar = tqdm(enumerate(train_loader), total=len(train_loader), desc='Train ')
-    for _, (images, masks) in pbar:
+    timer.start()
+    for step, (images, masks) in pbar:
+        timer.mark('data')
         optimizer.zero_grad()
 
         images = images.to(CFG.device, dtype=torch.float) # [b, c, w, h]
         masks  = masks.to(CFG.device, dtype=torch.float)  # [b, c, w, h]
+        timer.mark('h2d')
 
         with amp.autocast(enabled=True):
             y_preds = model(images) # [b, c, w, h]
+            timer.mark('forward')
         
             bce_loss = losses_dict["BCELoss"](y_preds, masks)
             tverskly_loss = losses_dict["TverskyLoss"](y_preds, masks)
             losses = bce_loss + tverskly_loss
+            timer.mark('loss')
         
         scaler.scale(losses).backward()
+        timer.mark('backward')
         scaler.step(optimizer)
         scaler.update()
+        timer.mark('optimizer')
+        timer.count(images.shape[0])
         
-        losses_all += losses.item() / images.shape[0]
-        bce_all += bce_loss.item() / images.shape[0]
-        tverskly_all += tverskly_loss.item() / images.shape[0]
+        loss_sums += torch.stack([losses, bce_loss, tverskly_loss]).detach().float() / images.shape[0]
+        if CFG.log_interval and (step + 1) % CFG.log_interval == 0: # the only read back inside the loop
+            pbar.set_postfix(loss='{:.3f}'.format(loss_sums[0].item()))
     
+    losses_all, bce_all, tverskly_all = loss_sums.tolist()
     current_lr = optimizer.param_groups[0]['lr']
     print("lr: {:.4f}".format(current_lr), flush=True)
     print("loss: {:.3f}, bce_all: {:.3f}, tverskly_all: {:.3f}".format(losses_all, bce_all, tverskly_all), flush=True)
         
 @torch.no_grad()
-def valid_one_epoch(model, valid_loader, CFG):
+def valid_one_epoch(model, valid_loader, CFG, timer=None):
     model.eval()
-    val_scores = []
+    timer = timer or PhaseTimer(False, CFG.device)
+    meter = DiceIoUMeter(CFG.num_classes, CFG.device)
     
     pbar = tqdm(enumerate(valid_loader), total=len(valid_loader), desc='Valid ')
+    timer.start()
     for _, (images, masks) in pbar:
+        timer.mark('data')
         images  = images.to(CFG.device, dtype=torch.float) # [b, c, w, h]
         masks   = masks.to(CFG.device, dtype=torch.float)  # [b, c, w, h]
+        timer.mark('h2d')
         
         y_preds = model(images) 
         y_preds   = torch.nn.Sigmoid()(y_preds) # [b, c, w, h]
+        timer.mark('forward')
         
-        val_dice = dice_coef(masks, y_preds).cpu().detach().numpy()
-        val_jaccard = iou_coef(masks, y_preds).cpu().detach().numpy()
-        val_scores.append([val_dice, val_jaccard])
+        meter.update(masks, y_preds)
+        timer.mark('metric')
+        timer.count(images.shape[0])
         
-    val_scores  = np.mean(val_scores, axis=0)
-    val_dice, val_jaccard = val_scores
+    val_dice, val_jaccard, class_dice = meter.compute()
     print("val_dice: {:.4f}, val_jaccard: {:.4f}".format(val_dice, val_jaccard), flush=True)
+    print("large_bowel: {:.4f}, small_bowel: {:.4f}, stomach: {:.4f}".format(*class_dice), flush=True)
     
     return val_dice, val_jaccard
 
 @torch.no_grad()
-def test_one_epoch(ckpt_paths, test_loader, CFG):
+def test_one_epoch(ckpt_paths, test_loader, CFG, sub_writer=None):
     pred_strings = []
     pred_ids = []
     pred_classes = []
     
+    start_time = time.time()
+    models = build_model_pool(ckpt_paths, CFG)
+    load_time = time.time() - start_time
+    forward_time = 0
+
     pbar = tqdm(enumerate(test_loader), total=len(test_loader), desc='Test: ')
     for _, (images, ids, h, w) in pbar:
 
@@ -377,21 +942,134 @@ def test_one_epoch(ckpt_paths, test_loader, CFG):
         ############################################
         #cross validation infer
         ############################################
-        for sub_ckpt_path in ckpt_paths:
-            model = build_model(CFG, test_flag=True)
-            model.load_state_dict(torch.load(sub_ckpt_path))
-            model.eval()
+        start_time = time.time()
+        for model in models:
             y_preds = model(images) # [b, c, w, h]
             y_preds   = torch.nn.Sigmoid()(y_preds)
-            masks += y_preds/len(ckpt_paths)
+            masks += y_preds/len(models)
         
         masks = (masks.permute((0, 2, 3, 1))>CFG.thr).to(torch.uint8).cpu().detach().numpy() # [n, h, w, c]
+        forward_time += time.time() - start_time # .cpu() above waits for the gpu
         result = masks2rles(masks, ids, h, w)
-        pred_strings.extend(result[0])
-        pred_ids.extend(result[1])
-        pred_classes.extend(result[2])
+        if sub_writer is not None:
+            sub_writer.write(*result)
+        else:
+            pred_strings.extend(result[0])
+            pred_ids.extend(result[1])
+            pred_classes.extend(result[2])
+
+    print("load models: {:.2f}s, forward: {:.2f}s".format(load_time, forward_time), flush=True)
     return pred_strings, pred_ids, pred_classes
 
+###############################################################
+#part6: cross validation <<<<<<
+###############################################################
+def train_fold(df, fold, ckpt_path, CFG):
+    """
+    train & validate one fold, resuming from {ckpt_path}/state_fold{fold}.pth when CFG.resume.
+    returns the fold's row of the cv summary.
+    """
+    print(f'#'*80, flush=True)
+    print(f'###### Fold: {fold}', flush=True)
+    print(f'#'*80, flush=True)
+    state_path = f"{ckpt_path}/state_fold{fold}.pth"
+    state = None
+    if CFG.resume and os.path.isfile(state_path):
+        state = torch.load(state_path, map_location='cpu', weights_only=False)
+        if state["epoch"] >= CFG.epoch:
+            print(f'###### Fold: {fold} already trained, skip', flush=True)
+            best_val_dice, best_epoch = state["best_val_dice"], state["best_epoch"]
+            return {"fold": fold, "best_val_dice": best_val_dice, "best_epoch": best_epoch, "ckpt_path": f"{ckpt_path}/best_fold{fold}.pth"}
+
+    ###############################################################
+    #step2: combination
+    #build_transforme() & build_dataset() & build_dataloader()
+    #build_model() & build_loss()
+    ###############################################################
+    data_transforms = build_transforms(CFG)  
+    train_loader, valid_loader = build_dataloader(df, fold, data_transforms, CFG) # dataset & dtaloader
+    model = build_model(CFG) # model
+    optimizer = torch.optim.AdamW(model.parameters(), lr=CFG.lr, weight_decay=CFG.wd)
+    lr_scheduler = torch.optim.lr_scheduler.StepLR(optimizer, CFG.lr_drop) 
+    scaler = amp.GradScaler()
+    losses_dict = build_loss() # loss
+
+    best_val_dice = 0
+    best_epoch = 0
+    start_epoch = 1
+    if state is not None:
+        last_epoch, best_val_dice, best_epoch = load_training_state(state, model, optimizer, lr_scheduler, scaler)
+        start_epoch = last_epoch + 1
+        print(f'###### Fold: {fold} resume after epoch {last_epoch}', flush=True)
+
+    ckpt_writer = CheckpointWriter()
+    for epoch in range(start_epoch, CFG.epoch+1):
+        start_time = time.time()
+        ###############################################################
+        #step3: train & val 
+        ###############################################################
+        train_timer = PhaseTimer(CFG.profile_phases, CFG.device)
+        valid_timer = PhaseTimer(CFG.profile_phases, CFG.device)
+        train_one_epoch(model, train_loader, optimizer, losses_dict, CFG, train_timer, scaler)
+        lr_scheduler.step()
+        val_dice, val_jaccard = valid_one_epoch(model, valid_loader, CFG, valid_timer)
+        cache_stats = valid_loader.dataset.slice_cache.stats() # this epoch, over all valid workers
+        print("slice cache: {hits} hits, {misses} misses, hit_rate: {hit_rate:.3f}".format(**cache_stats), flush=True)
+        valid_loader.dataset.slice_cache.reset()
+        if CFG.profile_phases:
+            save_phase_times(f"{ckpt_path}_timing/fold{fold}_epoch{epoch}.json", train=train_timer, valid=valid_timer)
+
+        ###############################################################
+        #step4: save best model
+        ###############################################################
+        is_best = (val_dice > best_val_dice)
+        best_val_dice = max(best_val_dice, val_dice)
+        if is_best:
+            best_epoch = epoch
+            ckpt_writer.save(model.state_dict(), f"{ckpt_path}/best_fold{fold}.pth")
+        ckpt_writer.save(training_state(fold, epoch, model, optimizer, lr_scheduler, scaler, best_val_dice, best_epoch), state_path)
+
+        epoch_time = time.time() - start_time
+        print("epoch:{}, time:{:.2f}s, best:{:.2f}\n".format(epoch, epoch_time, best_val_dice), flush=True)
+    ckpt_writer.close() # checkpoints are on disk before inference globs them
+    return {"fold": fold, "best_val_dice": best_val_dice, "best_epoch": best_epoch, "ckpt_path": f"{ckpt_path}/best_fold{fold}.pth"}
+
+def train_fold_worker(df, fold, ckpt_path, cfg_dict):
+    ##### entry of a spawned fold process: the CFG class lives in __main__, so it travels as a dict
+    CFG = type('CFG', (), cfg_dict)
+    torch.set_num_threads(CFG.fold_threads)
+    set_seed(CFG.seed)
+    return train_fold(df, fold, ckpt_path, CFG)
+
+def run_folds(df, folds, ckpt_path, CFG):
+    """
+    CFG.fold_parallel <= 1: folds one after another in this process, as before.
+    otherwise up to CFG.fold_parallel folds at once, each in its own spawned process with an equal
+    share of CFG.cpu_threads and CFG.num_worker; the folds go round robin over the visible gpus.
+    the per-fold best dice & checkpoint are saved to {ckpt_path}/cv_summary.csv
+    """
+    if CFG.fold_parallel <= 1:
+        results = [train_fold(df, fold, ckpt_path, CFG) for fold in folds]
+    else:
+        n_parallel = min(CFG.fold_parallel, len(folds))
+        cfg_dict = {key: value for key, value in vars(CFG).items() if not key.startswith('__')}
+        cfg_dict['fold_threads'] = max(1, (CFG.cpu_threads or os.cpu_count()) // n_parallel)
+        cfg_dict['num_worker'] = CFG.num_worker // n_parallel
+        n_gpu = torch.cuda.device_count()
+        with ProcessPoolExecutor(max_workers=n_parallel, mp_context=mp.get_context('spawn')) as executor:
+            futures = []
+            for i, fold in enumerate(folds):
+                fold_cfg = dict(cfg_dict)
+                if n_gpu:
+                    fold_cfg['device'] = torch.device(f"cuda:{i % n_gpu}")
+                futures.append(executor.submit(train_fold_worker, df, fold, ckpt_path, fold_cfg))
+            results = [future.result() for future in futures]
+
+    cv_summary = pd.DataFrame(results)
+    cv_summary.to_csv(f"{ckpt_path}/cv_summary.csv", index=False)
+    print(cv_summary.to_string(index=False), flush=True)
+    return cv_summary
+
 
 if __name__ == '__main__':
     ###############################################################
@@ -401,6 +1079,8 @@ if __name__ == '__main__':
         # step1: hyper-parameter
         seed = 66
         num_worker = 16 # debug => 0
+        fold_parallel = 1 # folds trained at once, each in its own process
+        cpu_threads = None # cpu threads split between the fold processes, None => os.cpu_count()
         device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
         ckpt_fold = "ckpt-frank"
         ckpt_name = "resnext101_32x8d_img224224_bs128_fold4_2.5d_shift1"
@@ -410,8 +1090,15 @@ if __name__ == '__main__':
     
         # step2: data
         n_25d_shift = 1
+        slice_cache_mb = 2048 # decoded-slice cache of the valid/test loaders, total over the DataLoader workers, 0 => off
+        volume_store = None # dir written by pack_volumes.py, None => read pngs (slices not packed there, eg: test, still come from png)
+        mask_store = None # dir written by pack_masks.py, None => read the npy mask tree
+        mask_from_rle = False # decode masks from the train.csv rles instead, no mask files needed
+        volume_infer = False # test set read volume by volume, see build_volume_dataset
+        index_cache = './index_cache' # parquet train index keyed on the csv hash, None => rebuild
         n_fold = 4
         img_size = [384, 384]
+        train_img_sizes = [[224, 224], [256, 256], [288, 288], [320, 320], [352, 352], [384, 384], img_size] # one per batch
         train_bs = 32
         valid_bs = train_bs * 2
 
@@ -426,6 +1113,9 @@ if __name__ == '__main__':
         lr = 1e-3
         wd = 1e-5
         lr_drop = 8
+        profile_phases = False # per-phase step timing -> {ckpt_path}_timing/*.json
+        log_interval = 50 # steps between loss read backs (0 => once per epoch)
+        resume = True # continue from {ckpt_path}/state_fold*.pth, written after every epoch
 
         # step5: infer
         thr = 0.5
@@ -440,76 +1130,13 @@ if __name__ == '__main__':
         ###############################################################
         #part0: data preprocess
         ###############################################################
-        # document: https://pandas.pydata.org/docs/reference/frame.html
-        df = pd.read_csv('../input/uwmgi-mask-dataset/train.csv')
-        df['segmentation'] = df.segmentation.fillna('') 
-        # rle mask length
-        df['rle_len'] = df.segmentation.map(len)
-        # image/mask path
-        df['image_path'] = df.image_path.str.replace('/kaggle/','../') 
-        df['mask_path'] = df.mask_path.str.replace('/kaggle/','../')
-        df['mask_path'] = df.mask_path.str.replace('/png/','/np').str.replace('.png','.npy')
-
-        # rle list of each id
-        df2 = df.groupby(['id'])['segmentation'].agg(list).to_frame().reset_index()
-        # total length of all rles of each id
-        df2 = df2.merge(df.groupby(['id'])['rle_len'].agg(sum).to_frame().reset_index()) 
-        df = df.drop(columns=['segmentation', 'class', 'rle_len']) 
-        df = df.groupby(['id']).head(1).reset_index(drop=True)
-        # empty mask
-        df = df.merge(df2, on=['id']) 
-        df['empty'] = (df.rle_len==0) 
+        # paths, empty flags, slice neighbours & folds, cached under CFG.index_cache
+        df = load_train_index('../input/uwmgi-mask-dataset/train.csv', CFG)
 
         ###############################################################
         #cross validation train <<<<<<
         ###############################################################
-        # document: http://scikit-learn.org/stable/modules/generated/sklearn.model_selection.StratifiedGroupKFold.html
-        skf = StratifiedGroupKFold(n_splits=CFG.n_fold, shuffle=True, random_state=CFG.seed)
-        for fold, (train_idx, val_idx) in enumerate(skf.split(df, df['empty'], groups = df["case"])):
-            df.loc[val_idx, 'fold'] = fold
-        
-        for fold in range(CFG.n_fold):
-            print(f'#'*80, flush=True)
-            print(f'###### Fold: {fold}', flush=True)
-            print(f'#'*80, flush=True)
-
-            ###############################################################
-            #step2: combination
-            #build_transforme() & build_dataset() & build_dataloader()
-            #build_model() & build_loss()
-            ###############################################################
-            data_transforms = build_transforms(CFG)  
-            train_loader, valid_loader = build_dataloader(df, fold, data_transforms, CFG) # dataset & dtaloader
-            model = build_model(CFG) # model
-            optimizer = torch.optim.AdamW(model.parameters(), lr=CFG.lr, weight_decay=CFG.wd)
-            lr_scheduler = torch.optim.lr_scheduler.StepLR(optimizer, CFG.lr_drop) 
-            losses_dict = build_loss() # loss
-
-            best_val_dice = 0
-            best_epoch = 0
-            
-            for epoch in range(1, CFG.epoch+1):
-                start_time = time.time()
-                ###############################################################
-                #step3: train & val 
-                ###############################################################
-                train_one_epoch(model, train_loader, optimizer, losses_dict, CFG)
-                lr_scheduler.step()
-                val_dice, val_jaccard = valid_one_epoch(model, valid_loader, CFG)
-                
-                ###############################################################
-                #step4: save best model
-                ###############################################################
-                is_best = (val_dice > best_val_dice)
-                best_val_dice = max(best_val_dice, val_dice)
-                if is_best:
-                    save_path = f"{ckpt_path}/best_fold{fold}.pth"
-                    if os.path.isfile(save_path):
-                        os.remove(save_path) 
-                    torch.save(model.state_dict(), save_path)
-                
-                epoch_time = time.time() - start_time
-                print("epoch:{}, time:{:.2f}s, best:{:.2f}\n".format(epoch, epoch_time, best_val_dice), flush=True)
+        run_folds(df, range(CFG.n_fold), ckpt_path, CFG)
 
 
     test_flag = False
@@ -528,13 +1155,16 @@ if __name__ == '__main__':
             sub_firset = False
             sub_df = sub_df.drop(columns=['class','predicted']).drop_duplicates()
             paths = glob(f'../input/uw-madison-gi-tract-image-segmentation/test/**/*png',recursive=True)
-        sub_df = sub_df.apply(get_metadata,axis=1)
+        sub_df = ids2info(sub_df)
         path_df = pd.DataFrame(paths, columns=['image_path'])
-        path_df = path_df.apply(path2info, axis=1)
+        path_df = paths2info(path_df)
         test_df = sub_df.merge(path_df, on=['case','day','slice'], how='left')
 
         data_transforms = build_transforms(CFG)
-        test_dataset = build_dataset(test_df, label=False, transforms=data_transforms['valid_test'], cfg=CFG)
+        if CFG.volume_infer: # each scan decoded once, stacks slide over the volume
+            test_dataset = build_volume_dataset(test_df, transforms=data_transforms['valid_test'], cfg=CFG)
+        else:
+            test_dataset = build_dataset(test_df, label=False, transforms=data_transforms['valid_test'], cfg=CFG)
         test_loader  = DataLoader(test_dataset, batch_size=CFG.valid_bs, num_workers=2, shuffle=False, pin_memory=False)
 
         ###############################################################
@@ -544,22 +1174,16 @@ if __name__ == '__main__':
         ckpt_paths  = glob(f'{ckpt_path}/best*')
         assert len(ckpt_paths) == CFG.n_fold, "ckpt path error!"
 
-        pred_strings, pred_ids, pred_classes = test_one_epoch(ckpt_paths, test_loader, CFG)
 
         ###############################################################
-        #step3: submit
+        #step3: submit, rows are streamed into submission.csv batch by batch
         ###############################################################
-        pred_df = pd.DataFrame({
-            "id":pred_ids,
-            "class":pred_classes,
-            "predicted":pred_strings
-        })
         if not sub_firset:
             sub_df = pd.read_csv('../input/uw-madison-gi-tract-image-segmentation/sample_submission.csv')
             del sub_df['predicted']
         else:
             sub_df = pd.read_csv('../input/uw-madison-gi-tract-image-segmentation/train.csv')[:1000*3]
             del sub_df['segmentation']
-            
-        sub_df = sub_df.merge(pred_df, on=['id','class'])
-        sub_df.to_csv('submission.csv',index=False)
+
+        with SubmissionWriter('submission.csv', sub_df) as sub_writer:
+            test_one_epoch(ckpt_paths, test_loader, CFG, sub_writer)
@@ -0,0 +1,69 @@
+###############################################################
+        #  bit-pack the npy mask tree into one uint8 memmap per case/day
+        #  input : case*/case*_day*/scans/slice_XXXX.npy  [h, w, 3] uint8 0/255
+        #  output: {out_dir}/case*_day*.npy  [n_slice, h, ceil(w*3/8)] uint8, 1 bit per pixel & class
+        #          {out_dir}/index.csv       one row per slice
+        #  read back with build_dataset(..., cfg.mask_store=out_dir)
+###############################################################
+
+import os
+import numpy as np
+import pandas as pd
+from glob import glob
+from tqdm import tqdm
+
+def mask_info(path):
+    #### eg: '../np/uw-madison-gi-tract-image-segmentation/train/case123/case123_day20/scans/slice_0001.npy'
+    volume = os.path.basename(os.path.dirname(os.path.dirname(path))) # eg: case123_day20
+    case, day = volume.split('_')
+    return {
+        "volume": volume,
+        "case": int(case.replace('case','')),
+        "day": int(day.replace('day','')),
+        "slice": int(os.path.basename(path)[:-4].split('_')[1]),
+    }
+
+def pack_bits(mask):
+    # [h, w, 3] => [h, ceil(w*3/8)], any non-zero value counts as the organ
+    return np.packbits(mask.reshape(mask.shape[0], -1) > 0, axis=-1)
+
+def pack_masks(mask_root, out_dir):
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    paths = glob(f'{mask_root}/**/scans/*.npy', recursive=True)
+    path_df = pd.DataFrame([mask_info(path) for path in paths])
+    path_df['mask_path'] = paths
+    path_df = path_df.sort_values(['case', 'day', 'slice']).reset_index(drop=True)
+    path_df['position'] = path_df.groupby('volume').cumcount() # row of the slice inside its memmap
+
+    shapes = {}
+    for volume, volume_df in tqdm(path_df.groupby('volume', sort=False), desc='Pack '):
+        ##### Through EDA, masks in the same day are in the same shape
+        height, width = np.load(volume_df.mask_path.iloc[0], mmap_mode='r').shape[:2]
+        packed = np.lib.format.open_memmap(f'{out_dir}/{volume}.npy', mode='w+', dtype=np.uint8,
+                                           shape=(len(volume_df), height, (width*3+7)//8))
+        for position, mask_path in zip(volume_df.position, volume_df.mask_path):
+            mask = np.load(mask_path)
+            assert mask.shape == (height, width, 3), f"{mask_path}: {mask.shape} != {(height, width, 3)}"
+            packed[position] = pack_bits(mask)
+        packed.flush()
+        del packed
+        shapes[volume] = (height, width)
+
+    path_df['height'] = path_df.volume.map(lambda volume: shapes[volume][0])
+    path_df['width'] = path_df.volume.map(lambda volume: shapes[volume][1])
+    path_df.drop(columns=['mask_path']).to_csv(f'{out_dir}/index.csv', index=False)
+    return path_df
+
+
+if __name__ == '__main__':
+    class CFG:
+        mask_root = '../input/uwmgi-mask-dataset/np/uw-madison-gi-tract-image-segmentation/train'
+        out_dir = '../input/uwmgi-packed-masks/train'
+
+    path_df = pack_masks(CFG.mask_root, CFG.out_dir)
+    npy_bytes = sum(os.path.getsize(path) for path in glob(f'{CFG.mask_root}/**/scans/*.npy', recursive=True))
+    packed_bytes = sum(os.path.getsize(path) for path in glob(f'{CFG.out_dir}/*.npy'))
+    print("packed {} masks of {} volumes into {}: {:.1f}MB => {:.1f}MB".format(
+        len(path_df), path_df.volume.nunique(), CFG.out_dir, npy_bytes/1024**2, packed_bytes/1024**2), flush=True)
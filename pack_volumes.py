@@ -0,0 +1,64 @@
+###############################################################
+        #  pack the png scan tree into one uint16 memmap per case/day
+        #  input : case*/case*_day*/scans/slice_XXXX_W_H_sx_sy.png
+        #  output: {out_dir}/case*_day*.npy  [n_slice, h, w] uint16
+        #          {out_dir}/index.csv       one row per slice
+        #  read back with build_dataset(..., cfg.volume_store=out_dir)
+###############################################################
+
+import os
+import cv2
+import numpy as np
+import pandas as pd
+from glob import glob
+from tqdm import tqdm
+
+def slice_info(path):
+    #### eg: '../train/case123/case123_day20/scans/slice_0001_266_266_1.50_1.50.png'
+    data = os.path.basename(path)[:-4].split('_')
+    volume = os.path.basename(os.path.dirname(os.path.dirname(path))) # eg: case123_day20
+    case, day = volume.split('_')
+    return {
+        "volume": volume,
+        "case": int(case.replace('case','')),
+        "day": int(day.replace('day','')),
+        "slice": int(data[1]),
+        "width": int(data[2]),
+        "height": int(data[3]),
+        "spacing_x": float(data[4]),
+        "spacing_y": float(data[5]),
+    }
+
+def pack_volumes(scan_root, out_dir):
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    paths = glob(f'{scan_root}/**/scans/*.png', recursive=True)
+    path_df = pd.DataFrame([slice_info(path) for path in paths])
+    path_df['image_path'] = paths
+    path_df = path_df.sort_values(['case', 'day', 'slice']).reset_index(drop=True)
+    path_df['position'] = path_df.groupby('volume').cumcount() # row of the slice inside its memmap
+
+    for volume, volume_df in tqdm(path_df.groupby('volume', sort=False), desc='Pack '):
+        ##### Through EDA, images in the same day are in the same shape
+        first = cv2.imread(volume_df.image_path.iloc[0], cv2.IMREAD_UNCHANGED)
+        packed = np.lib.format.open_memmap(f'{out_dir}/{volume}.npy', mode='w+', dtype=np.uint16,
+                                           shape=(len(volume_df), *first.shape))
+        for position, img_path in zip(volume_df.position, volume_df.image_path):
+            img = cv2.imread(img_path, cv2.IMREAD_UNCHANGED)
+            assert img.shape == first.shape, f"{img_path}: {img.shape} != {first.shape}"
+            packed[position] = img
+        packed.flush()
+        del packed
+
+    path_df.drop(columns=['image_path']).to_csv(f'{out_dir}/index.csv', index=False)
+    return path_df
+
+
+if __name__ == '__main__':
+    class CFG:
+        scan_root = '../input/uw-madison-gi-tract-image-segmentation/train'
+        out_dir = '../input/uwmgi-packed-volumes/train'
+
+    path_df = pack_volumes(CFG.scan_root, CFG.out_dir)
+    print("packed {} slices of {} volumes into {}".format(len(path_df), path_df.volume.nunique(), CFG.out_dir), flush=True)